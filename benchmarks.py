@@ -0,0 +1,241 @@
+"""
+Benchmarks of the collector configuration and startup, run with synthetic inventories and a stub exporter so no
+database is needed:
+
+    python benchmarks.py [--sizes 10,100,1000,10000] [--output benchmark-results.json]
+
+Results are written as JSON so runs can be compared. The full pipeline benchmark runs only when the collector
+binary exists (COLLECTOR_COMMAND, or the OTEL_COLLECTOR_BINARY environment variable)
+"""
+import argparse
+import json
+import os
+import platform
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.request
+
+import yaml
+from builder import Builder, COLLECTOR_COMMAND
+from exposition import Sample, renderExposition
+from remotewrite import RemoteWriter
+from supervisor import ExporterSupervisor
+from testdata.listener import RemoteWriteListener
+
+DEFAULT_SIZES = [10, 100, 1000, 10000]
+STUB_EXPORTER_COMMAND = f'{sys.executable} testdata/stub_exporter.py'
+CONFIG_MODES = {
+    'exporter': {},
+    'pooled': {'pg_targets_per_exporter': 10},
+    'native': {'pg_native_engine': True},
+}
+
+
+def createInstances(count) -> list:
+    return [{'pg_host': f'bench-{i}.example.com', 'pg_port': 5432, 'pg_db': 'postgres', 'pg_user': 'postgres',
+             'pg_password': 'pass', 'pg_labels': [{'env': 'bench'}]} for i in range(count)]
+
+
+def createBuilder(tmpDir, instances, pgSettings, otelSettings=None) -> Builder:
+    otelConfigPath = os.path.join(tmpDir, 'otel-config.yml')
+    shutil.copy('./config_files/otel-config.yml', otelConfigPath)
+    builder = Builder('./testdata/test-config.yml', otelConfigPath)
+    builder.targetsPath = os.path.join(tmpDir, 'exporter-targets.json')
+    builder.config.pg['instances'] = instances
+    builder.config.pg.update(pgSettings)
+    builder.config.otel.update(otelSettings or {})
+    return builder
+
+
+# Returns the cpu seconds and rss bytes of a process and its descendants, from /proc
+def getProcessTreeStats(pid) -> dict:
+    children = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    fields = f.read().rsplit(')', 1)[1].split()
+                children.setdefault(int(fields[1]), []).append(int(entry))
+            except OSError:
+                continue
+    cpu = 0.0
+    rss = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        pending.extend(children.get(current, []))
+        try:
+            with open(f'/proc/{current}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        cpu += (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+        rss += int(fields[21]) * os.sysconf('SC_PAGE_SIZE')
+    return {'cpu_seconds': cpu, 'rss_bytes': rss}
+
+
+# Time, peak python memory and output size of updateOtelConfiguration
+def benchConfigGeneration(sizes) -> list:
+    results = []
+    for size in sizes:
+        instances = createInstances(size)
+        for mode, settings in CONFIG_MODES.items():
+            tmpDir = tempfile.mkdtemp()
+            try:
+                builder = createBuilder(tmpDir, instances, settings)
+                tracemalloc.start()
+                start = time.perf_counter()
+                builder.updateOtelConfiguration()
+                elapsed = time.perf_counter() - start
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                with open(builder.otelConfigPath) as f:
+                    receivers = len(yaml.safe_load(f)['receivers'])
+                results.append({'instances': size, 'mode': mode, 'seconds': elapsed, 'peak_memory_bytes': peak,
+                                'output_bytes': os.path.getsize(builder.otelConfigPath), 'receivers': receivers})
+            finally:
+                shutil.rmtree(tmpDir)
+    return results
+
+
+def isServing(port) -> bool:
+    try:
+        with urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics', timeout=1) as response:
+            return response.status == 200
+    except OSError:
+        return False
+
+
+# Time until every exporter serves metrics when the builder runs them, and their total rss. exporterCommand runs
+# in place of postgres_exporter, the stub by default; the real exporter serves its own metrics without a database
+def benchExporterStartup(sizes, maxProcesses, exporterCommand=STUB_EXPORTER_COMMAND) -> list:
+    results = []
+    for size in sizes:
+        for mode in ['exporter', 'pooled']:
+            tmpDir = tempfile.mkdtemp()
+            builder = createBuilder(tmpDir, createInstances(size), CONFIG_MODES[mode])
+            receivers = builder.createExporterReceivers()
+            if len(receivers) > maxProcesses:
+                shutil.rmtree(tmpDir)
+                continue
+            for receiver in receivers.values():
+                receiver['exec'] = exporterCommand
+            supervisor = ExporterSupervisor(builder.targetsPath)
+            try:
+                start = time.perf_counter()
+                supervisor.apply(receivers)
+                pending = [receiver['port'] for receiver in receivers.values()]
+                while pending and time.perf_counter() - start < 120:
+                    pending = [port for port in pending if not isServing(port)]
+                elapsed = time.perf_counter() - start
+                rss = sum(getProcessTreeStats(process.pid)['rss_bytes'] for process in supervisor.processes.values())
+                results.append({'instances': size, 'mode': mode, 'exporter': exporterCommand,
+                                'processes': len(receivers), 'seconds_to_serving': elapsed,
+                                'not_serving': len(pending), 'rss_bytes': rss})
+            finally:
+                supervisor.stopAll()
+                shutil.rmtree(tmpDir)
+    return results
+
+
+# Runs the collector with stub exporters against a local listener: time to the first sample, then cpu and rss of
+# the collector and its exporters in steady state
+def benchPipeline(sizes, maxProcesses, steadySeconds) -> list:
+    binary = os.environ.get('OTEL_COLLECTOR_BINARY', shlex.split(COLLECTOR_COMMAND)[0])
+    if not os.path.exists(binary):
+        return [{'skipped': f'collector binary {binary} not found'}]
+    results = []
+    for size in sizes:
+        tmpDir = tempfile.mkdtemp()
+        with RemoteWriteListener() as listener:
+            mode = 'exporter' if size <= maxProcesses else 'pooled'
+            builder = createBuilder(tmpDir, createInstances(size), dict(CONFIG_MODES[mode], pg_scrape_interval=10,
+                                                                         pg_scrape_timeout=10),
+                                    {'custom_listener': listener.url})
+            receivers = builder.createExporterReceivers()
+            if len(receivers) > maxProcesses:
+                shutil.rmtree(tmpDir)
+                continue
+            builder.updateOtelConfiguration()
+            with open(builder.otelConfigPath) as f:
+                values = yaml.safe_load(f)
+            for receiver in values['receivers'].values():
+                if receiver.get('exec') == './postgres_exporter':
+                    receiver['exec'] = STUB_EXPORTER_COMMAND
+            with open(builder.otelConfigPath, 'w') as f:
+                yaml.safe_dump(values, f)
+            start = time.perf_counter()
+            collector = subprocess.Popen([binary, '--config', builder.otelConfigPath], stdout=subprocess.DEVNULL,
+                                         stderr=subprocess.DEVNULL)
+            try:
+                while not listener.series and time.perf_counter() - start < 120 and collector.poll() is None:
+                    time.sleep(0.1)
+                firstSample = time.perf_counter() - start if listener.series else None
+                before = getProcessTreeStats(collector.pid)
+                time.sleep(steadySeconds)
+                after = getProcessTreeStats(collector.pid)
+                results.append({'instances': size, 'mode': mode, 'seconds_to_first_sample': firstSample,
+                                'cpu_percent': 100 * (after['cpu_seconds'] - before['cpu_seconds']) / steadySeconds,
+                                'rss_bytes': after['rss_bytes'], 'series_received': len(listener.series)})
+            finally:
+                collector.terminate()
+                collector.wait()
+                shutil.rmtree(tmpDir)
+    return results
+
+
+# Cost per sample of the direct remote write path, next to the cost of rendering the same samples for the collector
+def benchRemoteWrite(seriesCount=25000, rounds=20) -> dict:
+    samples = [Sample('pg_bench_value', (('server', f'bench-{i // 250}.example.com:5432'), ('id', str(i % 250))),
+                      float(i), 'gauge', 'Benchmark value') for i in range(seriesCount)]
+    start = time.process_time()
+    for _ in range(rounds):
+        renderExposition(samples)
+    renderCpu = time.process_time() - start
+    with RemoteWriteListener(decode=False) as listener:
+        writer = RemoteWriter(listener.url, batchInterval=0.5)
+        writer.start()
+        wallStart = time.perf_counter()
+        cpuStart = time.process_time()
+        for _ in range(rounds):
+            writer.push(samples)
+        writer.close()
+        wall = time.perf_counter() - wallStart
+        cpu = time.process_time() - cpuStart
+    total = seriesCount * rounds
+    return {'samples': total, 'samples_per_second': total / wall, 'cpu_us_per_sample': 1e6 * cpu / total,
+            'requests': len(listener.requests), 'bytes_per_sample': listener.receivedBytes / total,
+            'exposition_cpu_us_per_sample': 1e6 * renderCpu / total}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default=','.join(str(size) for size in DEFAULT_SIZES))
+    parser.add_argument('--output', default='benchmark-results.json')
+    parser.add_argument('--max-processes', type=int, default=100,
+                        help='skip startup runs that would start more exporter processes')
+    parser.add_argument('--steady-seconds', type=float, default=30)
+    parser.add_argument('--exporter-command', default=STUB_EXPORTER_COMMAND,
+                        help='command run in place of postgres_exporter by the startup runs')
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(',')]
+    results = {
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'cpus': os.cpu_count(), 'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())},
+        'config_generation': benchConfigGeneration(sizes),
+        'exporter_startup': benchExporterStartup(sizes, args.max_processes, args.exporter_command),
+        'pipeline': benchPipeline(sizes, args.max_processes, args.steady_seconds),
+        'remote_write': benchRemoteWrite(),
+    }
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,27 +1,46 @@
+import hashlib
+import json
 import logging
 import os
-import random
-import string
+import shlex
+import subprocess
+import sys
 import time
 
 from config import Config
+import inventory
+from ports import PortAllocator, DEFAULT_PORT_RANGE_START, DEFAULT_PORT_RANGE_SIZE
+from supervisor import ExporterSupervisor
 import yaml
-import socket
-from contextlib import closing
+from urllib.parse import quote, urlencode
 
+# rough number of samples one instance produces per scrape, used to size the batches
+SAMPLES_PER_INSTANCE = 250
+MIN_BATCH_SIZE = 1000
+MAX_BATCH_SIZE = 10000
+COLLECTOR_METRICS_ADDRESS = 'localhost:8888'
+SUPERVISOR_ID = 'exporter-supervisor'
+DIRECT_COMMAND = 'python3 scraper.py'
+COLLECTOR_COMMAND = '/otelcontribcol_linux_amd64 --config ./config_files/otel-config.yml'
 
-def find_free_port():
-    with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as s:
-        s.bind(('', 0))
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        return s.getsockname()[1]
 
 
 class Builder:
     def __init__(self, configPath, otelConfigPath="./config_files/otel-config.yml") -> None:
+        self.configPath = configPath
         self.config = Config(configPath)
         self.logger = self.createLogger()
         self.otelConfigPath = otelConfigPath
+        self.targetsPath = os.path.join(os.path.dirname(otelConfigPath), 'exporter-targets.json')
+        # exporter receivers by id, when the builder runs the exporters itself
+        self.exporters = {}
+        # instance keys of every exporter group, so a reload keeps the groups of unchanged instances
+        self.groups = []
+        # port the supervisor serves the exporter process stats on
+        self.supervisorPort = None
+        if self.config.pg.get('pg_exporter_memory_budget'):
+            self.logger.warning('pg_exporter_memory_budget is no longer supported and is ignored, '
+                                'set pg_targets_per_exporter instead')
 
     # Initialize logger
     def createLogger(self) -> logging.Logger:
@@ -42,25 +61,139 @@ class Builder:
     def dumpAndCloseFile(moduleYaml, moduleFile) -> None:
         yaml.preserve_quotes = True
         moduleFile.seek(0)
-        yaml.dump(moduleYaml, moduleFile)
+        # libyaml's emitter is an order of magnitude faster with thousands of receivers
+        yaml.dump(moduleYaml, moduleFile, Dumper=getattr(yaml, 'CDumper', yaml.Dumper))
         moduleFile.truncate()
         moduleFile.close()
 
-    # Finds free port
+    # Returns the postgres connection string of a single instance
+    @staticmethod
+    def getInstanceDsn(instance) -> str:
+        user = quote(str(instance['pg_user']), safe='')
+        password = quote(str(instance['pg_password']), safe='')
+        return f"postgresql://{user}:{password}@{instance['pg_host']}:{instance['pg_port']}/{instance.get('pg_db', 'postgres')}"
+
+    # Returns how many instances should share one exporter process
+    def getTargetsPerExporter(self) -> int:
+        return max(int(self.config.pg.get('pg_targets_per_exporter', 1)), 1)
+
+    # Returns the scrape timeout of an exporter process with groupSize targets. The process scrapes its targets one
+    # after another, so the timeout grows with the group, but prometheus does not allow more than the interval
+    def getScrapeTimeout(self, groupSize) -> int:
+        timeout = int(self.config.pg['pg_scrape_timeout'])
+        if groupSize <= 1:
+            return timeout
+        return min(timeout * groupSize, int(self.config.pg['pg_scrape_interval']))
+
+    # Returns the settings that are set per exporter process, only instances with equal settings can share one
+    @staticmethod
+    def getGroupSettings(instance) -> str:
+        return json.dumps([instance.get('pg_labels'), instance.get('pg_discover_databases', False),
+                           instance.get('pg_exclude_databases')], sort_keys=True)
+
+    # Splits the instances into groups, each group is scraped by a single exporter process.
+    # Constant labels and database discovery are set per process, so only instances with identical settings
+    # can share one. Postgres exporter tells the targets of a process apart by host:port only, so databases of
+    # the same server always go to different processes. previous lists the instance keys of the current groups:
+    # instances that are still there keep their group, so only groups that lost or gained an instance change.
+    # New instances fill the groups that have room, then new groups
+    def groupInstances(self, previous=None) -> list:
+        instances = self.config.pg['instances']
+        targetsPerExporter = self.getTargetsPerExporter()
+        if targetsPerExporter == 1:
+            return [[instance] for instance in instances]
+        byKey = {Config.getInstanceKey(instance): instance for instance in instances}
+        # (instances, servers) of every group, and of the groups with room by settings
+        groups = []
+        pending = {}
+        kept = set()
+        for keys in previous or []:
+            members = [byKey[key] for key in keys if key in byKey and key not in kept]
+            if not members:
+                continue
+            settings = self.getGroupSettings(members[0])
+            members = [member for member in members if self.getGroupSettings(member) == settings]
+            kept.update(Config.getInstanceKey(member) for member in members)
+            group = (members, {f"{m['pg_host']}:{m['pg_port']}" for m in members})
+            groups.append(group)
+            if len(members) < targetsPerExporter:
+                pending.setdefault(settings, []).append(group)
+        for instance in instances:
+            if Config.getInstanceKey(instance) in kept:
+                continue
+            settings = self.getGroupSettings(instance)
+            server = f"{instance['pg_host']}:{instance['pg_port']}"
+            candidates = pending.setdefault(settings, [])
+            target = next((group for group in candidates if server not in group[1]), None)
+            if target is None:
+                target = ([], set())
+                groups.append(target)
+                candidates.append(target)
+            target[0].append(instance)
+            target[1].add(server)
+            if len(target[0]) >= targetsPerExporter:
+                candidates.remove(target)
+        return [group[0] for group in groups]
+
+    # Returns a receiver id that stays the same as long as the instances of the group and their settings do,
+    # passwords are left out so rotating one does not change the id
+    @staticmethod
+    def getReceiverId(group) -> str:
+        settings = [{k: v for k, v in instance.items() if k != 'pg_password'} for instance in group]
+        digest = hashlib.sha1(json.dumps(settings, sort_keys=True, default=str).encode()).hexdigest()[:10]
+        name = f'postgres-{group[0]["pg_host"]}' if len(group) == 1 else 'postgres-pool'
+        return f'{name}-{digest}'
+
+    # Returns the exporter receivers of all instances by id, receivers in current keep their port
+    def createExporterReceivers(self, current=None) -> dict:
+        current = current or {}
+        groups = {}
+        for group in self.groupInstances(self.groups):
+            receiverId = self.getReceiverId(group)
+            if receiverId in groups:
+                self.logger.warning(f'Dropping duplicate instance {Config.getInstanceKey(group[0])}')
+                continue
+            groups[receiverId] = group
+        reserved = {receiverId: receiver['port'] for receiverId, receiver in current.items()}
+        if self.supervisorPort is not None:
+            reserved[SUPERVISOR_ID] = self.supervisorPort
+        ports = self.allocatePorts(list(groups), reserved)
+        self.groups = [[Config.getInstanceKey(instance) for instance in group] for group in groups.values()]
+        return {receiverId: self.createExporter(group, ports[receiverId]) for receiverId, group in groups.items()}
+
+    # Returns a port from the configured range for every receiver id, see ports.PortAllocator
+    def allocatePorts(self, receiverIds, reserved=None) -> dict:
+        allocator = PortAllocator(self.config.pg.get('pg_port_range_start', DEFAULT_PORT_RANGE_START),
+                                  self.config.pg.get('pg_port_range_size', DEFAULT_PORT_RANGE_SIZE))
+        return allocator.allocate(receiverIds, reserved)
 
     # Takes instance configuration and creates corresponding object for otel collector
     def createInstanceExporter(self, instance) -> dict:
-        port = find_free_port()
+        return self.createExporter([instance])
+
+    # Takes a group of instances and creates a single exporter object that scrapes all of them
+    def createExporter(self, instances, port=None) -> dict:
+        if port is None:
+            receiverId = self.getReceiverId(instances)
+            port = self.allocatePorts([receiverId])[receiverId]
+        timeout = self.getScrapeTimeout(len(instances))
         instanceObj = {
             'exec': './postgres_exporter',
             'scrape_interval': f"{self.config.pg['pg_scrape_interval']}s",
-            'scrape_timeout': f"{self.config.pg['pg_scrape_timeout']}s",
+            'scrape_timeout': f"{timeout}s",
             'port': port,
             'env': []
         }
+        # postgres exporter accepts a comma separated list of targets. The driver sends unknown connection
+        # parameters to the server as session settings, which is how the statement and lock timeouts are applied
+        dsnParams = Config.getSessionSettings(self.config.pg)
+        if len(instances) > 1:
+            # a target that does not accept the connection must not take the scrape time of the others
+            dsnParams['connect_timeout'] = max(timeout // len(instances), 1)
+        dsnSuffix = f'?{urlencode(dsnParams)}' if dsnParams else ''
         instanceObj['env'].append({
             "name": "DATA_SOURCE_NAME",
-            "value": f"postgresql://{instance['pg_user']}:{instance['pg_password']}@{instance['pg_host']}:{instance['pg_port']}/{instance['pg_db']}"
+            "value": ','.join(self.getInstanceDsn(instance) + dsnSuffix for instance in instances)
         })
         instanceObj['env'].append({
             "name": "PG_EXPORTER_DISABLE_DEFAULT_METRICS",
@@ -78,10 +211,19 @@ class Builder:
             "name": "PG_EXPORTER_EXTEND_QUERY_MR",
             "value": "true"
         })
+        if instances[0].get('pg_discover_databases', False):
+            instanceObj['env'].append({
+                "name": "PG_EXPORTER_AUTO_DISCOVER_DATABASES",
+                "value": "true"
+            })
+            instanceObj['env'].append({
+                "name": "PG_EXPORTER_EXCLUDE_DATABASES",
+                "value": ','.join(instances[0].get('pg_exclude_databases') or [])
+            })
         # generate label string
         try:
             labelsString = ''
-            for label in instance['pg_labels']:
+            for label in instances[0]['pg_labels']:
                 for k, v in label.items():
                     labelsString = f'{labelsString},{k}={v}'
 
@@ -94,17 +236,132 @@ class Builder:
 
         return instanceObj
 
+    # Creates a single receiver that runs the native scrape engine for all instances
+    def createNativeEngineReceiver(self) -> dict:
+        port = self.allocatePorts(['postgres-native'])['postgres-native']
+        return {
+            'exec': 'python3 scraper.py',
+            'scrape_interval': f"{self.config.pg['pg_scrape_interval']}s",
+            'scrape_timeout': f"{self.config.pg['pg_scrape_timeout']}s",
+            'port': port,
+            'env': [{
+                "name": "PG_NATIVE_ENGINE_PORT",
+                "value": f"{port}"
+            }]
+        }
+
+    # Creates a receiver that scrapes the exporters run by the builder, the collector picks up changes of the
+    # targets file without a restart. The process stats of the exporters are scraped from the supervisor
+    def createTargetsReceiver(self) -> dict:
+        interval = int(self.config.pg['pg_scrape_interval'])
+        # prometheus does not allow a timeout longer than the interval
+        timeout = min(self.getScrapeTimeout(self.getTargetsPerExporter()), interval)
+        scrapeConfigs = [{
+            'job_name': 'postgres',
+            'scrape_interval': f"{interval}s",
+            'scrape_timeout': f"{timeout}s",
+            'file_sd_configs': [{
+                'files': [self.targetsPath],
+                'refresh_interval': f"{self.getReloadInterval() or self.getSuperviseInterval()}s"
+            }]
+        }]
+        if self.supervisorPort is not None:
+            scrapeConfigs.append({
+                'job_name': SUPERVISOR_ID,
+                'scrape_interval': f"{interval}s",
+                'scrape_timeout': f"{timeout}s",
+                'static_configs': [{'targets': [f'localhost:{self.supervisorPort}']}]
+            })
+        return {'config': {'scrape_configs': scrapeConfigs}}
+
+    # Creates a receiver that scrapes the collector's own metrics, so sent, failed and refused samples and the
+    # sending queue are reported with the postgres metrics
+    def createCollectorMetricsReceiver(self) -> dict:
+        return {
+            'config': {
+                'scrape_configs': [{
+                    'job_name': 'otel-collector',
+                    'scrape_interval': f"{self.config.pg['pg_scrape_interval']}s",
+                    'static_configs': [{'targets': [COLLECTOR_METRICS_ADDRESS]}]
+                }]
+            }
+        }
+
+    # Returns the number of samples per batch, from the configuration or from the number of instances
+    # Returns the samples per batch of the batch processor, 0 when batching is off
+    def getBatchSize(self) -> int:
+        batchSize = self.config.otel.get('batch_size', 0)
+        if batchSize != 'auto':
+            return max(int(batchSize), 0)
+        return min(max(len(self.config.pg['instances']) * SAMPLES_PER_INSTANCE, MIN_BATCH_SIZE), MAX_BATCH_SIZE)
+
+    # Creates the processors that bound the memory of the collector and batch the samples, in pipeline order.
+    # Only the processors the user enabled are added, so the pipeline of a configuration without them is unchanged
+    def createProcessors(self) -> dict:
+        processors = {}
+        memoryLimit = int(self.config.otel.get('memory_limit_mib', 0))
+        if memoryLimit > 0:
+            processors['memory_limiter'] = {
+                'check_interval': '1s',
+                'limit_mib': memoryLimit,
+                'spike_limit_mib': max(memoryLimit // 5, 1)
+            }
+        batchSize = self.getBatchSize()
+        if batchSize > 0:
+            processors['batch'] = {
+                'send_batch_size': batchSize,
+                'send_batch_max_size': batchSize * 2,
+                'timeout': '5s'
+            }
+        return processors
+
+    def getReloadInterval(self) -> int:
+        return int(self.config.pg.get('pg_reload_interval', 0))
+
+    def getSuperviseInterval(self) -> int:
+        return int(self.config.pg.get('pg_supervise_interval', 5))
+
+    # Returns whether the builder runs the exporters itself instead of the collector
+    def isSupervised(self) -> bool:
+        if self.config.pg.get('pg_native_engine', False):
+            return False
+        return self.getReloadInterval() > 0 or bool(self.config.pg.get('pg_supervise_exporters', False))
+
     # Takes user input and applies it to open telemetry collector
     def updateOtelConfiguration(self) -> None:
         self.logger.info('Adding opentelemtry collector configuration')
         with open(self.otelConfigPath, 'r+') as otelFile:
             values = yaml.safe_load(otelFile)
+            # start from no receivers, so generating again gives the same file
+            values['receivers'] = {}
+            values['service']['pipelines']['metrics']['receivers'] = []
             # update pg
-            for instance in self.config.pg['instances']:
-                letters = string.ascii_lowercase
-                identifier = ''.join(random.choice(letters) for i in range(5))
-                values['receivers'][f'prometheus_exec/postgres-{instance["pg_host"]}-{identifier}'] = self.createInstanceExporter(instance)
-                values['service']['pipelines']['metrics']['receivers'].append(f'prometheus_exec/postgres-{instance["pg_host"]}-{identifier}')
+            if self.config.pg.get('pg_native_engine', False):
+                values['receivers']['prometheus_exec/postgres-native'] = self.createNativeEngineReceiver()
+                values['service']['pipelines']['metrics']['receivers'].append('prometheus_exec/postgres-native')
+                self.logger.info(f"Scraping {len(self.config.pg['instances'])} instances with the native engine")
+            elif self.isSupervised():
+                self.exporters = self.createExporterReceivers()
+                self.supervisorPort = self.allocatePorts([SUPERVISOR_ID], {
+                    receiverId: receiver['port'] for receiverId, receiver in self.exporters.items()})[SUPERVISOR_ID]
+                values['receivers']['prometheus/postgres'] = self.createTargetsReceiver()
+                values['service']['pipelines']['metrics']['receivers'].append('prometheus/postgres')
+                self.logger.info(f"Scraping {len(self.config.pg['instances'])} instances with "
+                                 f"{len(self.exporters)} exporter processes run by the builder")
+            else:
+                receivers = self.createExporterReceivers()
+                for receiverId, receiver in receivers.items():
+                    values['receivers'][f'prometheus_exec/{receiverId}'] = receiver
+                    values['service']['pipelines']['metrics']['receivers'].append(f'prometheus_exec/{receiverId}')
+                self.logger.info(f"Scraping {len(self.config.pg['instances'])} instances with "
+                                 f"{len(receivers)} exporter processes")
+            if self.config.otel.get('collector_self_metrics', False):
+                values['receivers']['prometheus/collector'] = self.createCollectorMetricsReceiver()
+                values['service']['pipelines']['metrics']['receivers'].append('prometheus/collector')
+            # Update processors
+            processors = self.createProcessors()
+            values['processors'] = processors or None
+            values['service']['pipelines']['metrics']['processors'] = list(processors)
             # Update exporter
             values['exporters']['prometheusremotewrite']['endpoint'] = self.config.getListenerUrl()
             values['exporters']['prometheusremotewrite']['timeout'] = f"{self.config.otel['remote_timeout']}s"
@@ -112,15 +369,83 @@ class Builder:
                 'Authorization'] = f"Bearer {self.config.otel['token']}"
             values['exporters']['prometheusremotewrite']['external_labels']['p8s_logzio_name'] = self.config.otel[
                 'p8s_logzio_name']
+            # retry and queue settings are only written when set, otherwise the exporter keeps its defaults
+            retryMaxElapsedTime = int(self.config.otel.get('retry_max_elapsed_time', 0))
+            if retryMaxElapsedTime > 0:
+                values['exporters']['prometheusremotewrite']['retry_on_failure'] = {
+                    'enabled': True,
+                    'initial_interval': '5s',
+                    'max_interval': '30s',
+                    'max_elapsed_time': f"{retryMaxElapsedTime}s"
+                }
+            # prometheusremotewrite of otelcol-contrib v0.45 (see the Dockerfile) has no sending_queue, its queue is
+            # remote_write_queue, which has no enabled key before later releases. Unknown keys fail the startup.
+            # A single consumer keeps the samples of a series in order
+            sendingQueueSize = int(self.config.otel.get('sending_queue_size', 0))
+            if sendingQueueSize > 0:
+                values['exporters']['prometheusremotewrite']['remote_write_queue'] = {
+                    'num_consumers': 1,
+                    'queue_size': sendingQueueSize
+                }
             # Update service
             values['service']['telemetry']['logs']['level'] = self.config.otel['log_level']
             self.dumpAndCloseFile(values, otelFile)
         self.logger.info('Opentelemtry collector configuration ready')
-        self.logger.debug(f'Opentelemtry collector configuration:\n{yaml.dump(values)}')
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(f'Opentelemtry collector configuration:\n{yaml.dump(values)}')
+
+    # Returns the modification times of the files the instances are loaded from
+    def getSourceState(self) -> list:
+        return inventory.getSourceState([self.configPath, self.config.pg.get('pg_inventory')])
+
+    # Loads the configuration again and applies the changes of the instance list to the running exporters
+    def reload(self, supervisor) -> None:
+        try:
+            self.config = Config(self.configPath)
+        except Exception as e:
+            self.logger.error(f'Failed to reload configuration, keeping the current instances: {e}')
+            return
+        self.exporters = self.createExporterReceivers(supervisor.receivers)
+        added, removed, changed = supervisor.apply(self.exporters)
+        self.logger.info(f'Reloaded instances: {len(added)} added, {len(removed)} removed, {len(changed)} changed, '
+                         f'{len(self.exporters) - len(added) - len(changed)} unchanged')
+
+    # Runs the collector and the exporters, restarts exporters that exit or break their limits, and applies
+    # changes of the instance list until the collector exits
+    def watch(self) -> int:
+        supervisor = ExporterSupervisor(self.targetsPath,
+                                        maxRssBytes=int(self.config.pg.get('pg_exporter_max_rss_mb', 0)) * 2 ** 20,
+                                        maxCpuPercent=float(self.config.pg.get('pg_exporter_max_cpu_percent', 0)))
+        supervisor.serveMetrics(self.supervisorPort)
+        supervisor.apply(self.exporters)
+        collector = subprocess.Popen(shlex.split(COLLECTOR_COMMAND))
+        state = self.getSourceState()
+        reloadInterval = self.getReloadInterval()
+        interval = min(self.getSuperviseInterval(), reloadInterval) if reloadInterval > 0 else \
+            self.getSuperviseInterval()
+        nextReload = time.monotonic() + reloadInterval
+        try:
+            while collector.poll() is None:
+                time.sleep(interval)
+                supervisor.supervise()
+                if reloadInterval <= 0 or time.monotonic() < nextReload:
+                    continue
+                nextReload = time.monotonic() + reloadInterval
+                if self.getSourceState() != state:
+                    state = self.getSourceState()
+                    self.reload(supervisor)
+        finally:
+            supervisor.stopAll()
+        return collector.returncode
 
 
 if __name__ == '__main__':
     builder = Builder('./config_files/config.yml')
     builder.updateOtelConfiguration()
     time.sleep(2.0)
-    os.system('/otelcontribcol_linux_amd64 --config ./config_files/otel-config.yml')
+    if builder.isSupervised():
+        sys.exit(builder.watch())
+    if builder.config.pg.get('pg_native_engine', False) and builder.config.otel.get('remote_write_direct', False):
+        os.system(DIRECT_COMMAND)
+    else:
+        os.system(COLLECTOR_COMMAND)
@@ -3,6 +3,8 @@ import logging
 from os import environ
 import yaml
 import input_validator as iv
+import inventory
+import sharding
 
 
 class Config:
@@ -28,24 +30,130 @@ class Config:
             self.otel['log_level'] = environ.get('LOG_LEVEL')
         if environ.get('LOGZIO_LOG_LEVEL') is not None:
             self.otel['logzio_log_level'] = environ.get('LOGZIO_LOG_LEVEL')
+        if environ.get('MEMORY_LIMIT_MIB') is not None:
+            self.otel['memory_limit_mib'] = int(environ.get('MEMORY_LIMIT_MIB'))
+        if environ.get('BATCH_SIZE') is not None:
+            batchSize = environ.get('BATCH_SIZE')
+            self.otel['batch_size'] = batchSize if batchSize == 'auto' else int(batchSize)
+        if environ.get('SENDING_QUEUE_SIZE') is not None:
+            self.otel['sending_queue_size'] = int(environ.get('SENDING_QUEUE_SIZE'))
+        if environ.get('RETRY_MAX_ELAPSED_TIME') is not None:
+            self.otel['retry_max_elapsed_time'] = int(environ.get('RETRY_MAX_ELAPSED_TIME'))
+        if environ.get('COLLECTOR_SELF_METRICS') is not None:
+            self.otel['collector_self_metrics'] = environ.get('COLLECTOR_SELF_METRICS').lower() == 'true'
+        if environ.get('REMOTE_WRITE_DIRECT') is not None:
+            self.otel['remote_write_direct'] = environ.get('REMOTE_WRITE_DIRECT').lower() == 'true'
+        if environ.get('REMOTE_WRITE_BATCH_SIZE') is not None:
+            self.otel['remote_write_batch_size'] = int(environ.get('REMOTE_WRITE_BATCH_SIZE'))
+        if environ.get('REMOTE_WRITE_BATCH_INTERVAL') is not None:
+            self.otel['remote_write_batch_interval'] = float(environ.get('REMOTE_WRITE_BATCH_INTERVAL'))
+        if environ.get('REMOTE_WRITE_CONNECTIONS') is not None:
+            self.otel['remote_write_connections'] = int(environ.get('REMOTE_WRITE_CONNECTIONS'))
+        if environ.get('REMOTE_WRITE_QUEUE_DIR') is not None:
+            self.otel['remote_write_queue_dir'] = environ.get('REMOTE_WRITE_QUEUE_DIR')
+        if environ.get('REMOTE_WRITE_QUEUE_MAX_MB') is not None:
+            self.otel['remote_write_queue_max_mb'] = int(environ.get('REMOTE_WRITE_QUEUE_MAX_MB'))
 
         # Pg exporter
         if environ.get('PG_SCRAPE_INTERVAL') is not None:
             self.pg['pg_scrape_interval'] = environ.get('PG_SCRAPE_INTERVAL')
         if environ.get('PG_SCRAPE_TIMEOUT') is not None:
             self.pg['pg_scrape_timeout'] = environ.get('PG_SCRAPE_TIMEOUT')
+        if environ.get('PG_TARGETS_PER_EXPORTER') is not None:
+            self.pg['pg_targets_per_exporter'] = int(environ.get('PG_TARGETS_PER_EXPORTER'))
+        if environ.get('PG_NATIVE_ENGINE') is not None:
+            self.pg['pg_native_engine'] = environ.get('PG_NATIVE_ENGINE').lower() == 'true'
+        if environ.get('PG_NATIVE_POOL_SIZE') is not None:
+            self.pg['pg_native_pool_size'] = int(environ.get('PG_NATIVE_POOL_SIZE'))
+        if environ.get('PG_PORT_RANGE_START') is not None:
+            self.pg['pg_port_range_start'] = int(environ.get('PG_PORT_RANGE_START'))
+        if environ.get('PG_PORT_RANGE_SIZE') is not None:
+            self.pg['pg_port_range_size'] = int(environ.get('PG_PORT_RANGE_SIZE'))
+        if environ.get('PG_SUPERVISE_EXPORTERS') is not None:
+            self.pg['pg_supervise_exporters'] = environ.get('PG_SUPERVISE_EXPORTERS').lower() == 'true'
+        if environ.get('PG_SUPERVISE_INTERVAL') is not None:
+            self.pg['pg_supervise_interval'] = int(environ.get('PG_SUPERVISE_INTERVAL'))
+        if environ.get('PG_EXPORTER_MAX_RSS_MB') is not None:
+            self.pg['pg_exporter_max_rss_mb'] = int(environ.get('PG_EXPORTER_MAX_RSS_MB'))
+        if environ.get('PG_EXPORTER_MAX_CPU_PERCENT') is not None:
+            self.pg['pg_exporter_max_cpu_percent'] = float(environ.get('PG_EXPORTER_MAX_CPU_PERCENT'))
+        if environ.get('PG_RELOAD_INTERVAL') is not None:
+            self.pg['pg_reload_interval'] = int(environ.get('PG_RELOAD_INTERVAL'))
+        if environ.get('PG_STATEMENT_TIMEOUT') is not None:
+            self.pg['pg_statement_timeout'] = float(environ.get('PG_STATEMENT_TIMEOUT'))
+        if environ.get('PG_LOCK_TIMEOUT') is not None:
+            self.pg['pg_lock_timeout'] = float(environ.get('PG_LOCK_TIMEOUT'))
+        if environ.get('PG_MAX_INTERVAL_FACTOR') is not None:
+            self.pg['pg_max_interval_factor'] = int(environ.get('PG_MAX_INTERVAL_FACTOR'))
+        if environ.get('PG_DISCOVERY_INTERVAL') is not None:
+            self.pg['pg_discovery_interval'] = int(environ.get('PG_DISCOVERY_INTERVAL'))
+        if environ.get('PG_DISCOVERY_MAX_CONNECTIONS') is not None:
+            self.pg['pg_discovery_max_connections'] = int(environ.get('PG_DISCOVERY_MAX_CONNECTIONS'))
+        if environ.get('PG_SELF_METRICS') is not None:
+            self.pg['pg_self_metrics'] = environ.get('PG_SELF_METRICS').lower() == 'true'
+        if environ.get('PG_SCRAPE_SPREAD') is not None:
+            self.pg['pg_scrape_spread'] = environ.get('PG_SCRAPE_SPREAD').lower() == 'true'
+        if environ.get('PG_MAX_CONCURRENT_SCRAPES') is not None:
+            self.pg['pg_max_concurrent_scrapes'] = int(environ.get('PG_MAX_CONCURRENT_SCRAPES'))
+        if environ.get('SHARD_INDEX') is not None:
+            self.pg['pg_shard_index'] = int(environ.get('SHARD_INDEX'))
+        if environ.get('SHARD_COUNT') is not None:
+            self.pg['pg_shard_count'] = int(environ.get('SHARD_COUNT'))
+        if environ.get('SHARD_NAME') is not None:
+            self.pg['pg_shard_name'] = environ.get('SHARD_NAME')
+        if environ.get('SHARD_MEMBERS') is not None:
+            self.pg['pg_shard_members'] = [m.strip() for m in environ.get('SHARD_MEMBERS').split(',') if m.strip()]
+        if environ.get('PG_INVENTORY') is not None:
+            self.pg['pg_inventory'] = environ.get('PG_INVENTORY')
+        if environ.get('PG_INVENTORY_CACHE') is not None:
+            self.pg['pg_inventory_cache'] = environ.get('PG_INVENTORY_CACHE').lower() == 'true'
         if environ.get('PG_INSTANCES') is not None:
             try:
                 instances = []
-                instancesRaw = environ.get('PG_INSTANCES').split(';')
-                for instance in instancesRaw:
-                    instance = json.loads(instance)
+                for instance in self.parseInstancesString(environ.get('PG_INSTANCES')):
                     validatedInstance = self.validatePgInstance(instance)
                     if validatedInstance is not None:
                         instances.append(validatedInstance)
             except Exception as e:
                 raise Exception(f"Failed to parse PG_INSTANCES string: {e}")
             self.pg['instances'] = instances
+        if self.pg.get('pg_inventory'):
+            self.loadInventory(self.pg['pg_inventory'])
+        self.applySharding()
+
+    # Returns the instances of a PG_INSTANCES string: JSON objects separated by ';' or whitespace, or a JSON list.
+    # Objects are decoded as a whole, so ';' inside a value such as a password is kept
+    @staticmethod
+    def parseInstancesString(value) -> list:
+        decoder = json.JSONDecoder()
+        instances = []
+        pos = 0
+        while True:
+            while pos < len(value) and (value[pos].isspace() or value[pos] == ';'):
+                pos += 1
+            if pos == len(value):
+                return instances
+            instance, pos = decoder.raw_decode(value, pos)
+            instances.extend(instance if isinstance(instance, list) else [instance])
+
+    # Adds the valid instances of an inventory file or directory, invalid entries are reported in one line
+    def loadInventory(self, path) -> None:
+        cachePath = inventory.getCachePath(path) if self.pg.get('pg_inventory_cache', False) else None
+        instances, errors = inventory.loadInventory(path, self.getInstanceError, cachePath)
+        if errors:
+            self.logger.warning(inventory.formatErrors(errors, len(instances) + len(errors)))
+        self.pg['instances'] = (self.pg.get('instances') or []) + instances
+        self.logger.info(f'Loaded {len(instances)} instances from {path}')
+
+    # Keeps only the instances of this replica when the fleet is split between replicas
+    def applySharding(self) -> None:
+        member, members = sharding.getMembership(self.pg)
+        if not members:
+            return
+        instances = self.pg.get('instances') or []
+        self.pg['instances'] = sharding.selectInstances(instances, member, members, self.getInstanceKey)
+        self.logger.info(f"Shard {member} of {len(members)} scrapes {len(self.pg['instances'])} of "
+                         f"{len(instances)} instances")
 
     # Returns the listener url based on the region input
     def getListenerUrl(self) -> str:
@@ -61,20 +169,44 @@ class Config:
             return "-{}".format(region)
         return ""
 
+    # Returns a stable identifier of an instance
+    @staticmethod
+    def getInstanceKey(instance) -> str:
+        return f"{instance['pg_host']}:{instance['pg_port']}/{instance.get('pg_db', '')}"
+
+    # Returns the postgres session settings for statement_timeout and lock_timeout, given in seconds by the
+    # pg_statement_timeout and pg_lock_timeout keys of settings, in milliseconds. Unset and 0 keep the server default
+    @staticmethod
+    def getSessionSettings(settings, prefix='pg_') -> dict:
+        sessionSettings = {}
+        for name in ['statement_timeout', 'lock_timeout']:
+            seconds = float(settings.get(f'{prefix}{name}') or 0)
+            if seconds > 0:
+                sessionSettings[name] = str(max(int(seconds * 1000), 1))
+        return sessionSettings
+
+    # Returns why an instance is invalid, or an empty string
+    @staticmethod
+    def getInstanceError(instance) -> str:
+        for key in ['pg_host', 'pg_port', 'pg_user', 'pg_password']:
+            if instance.get(key) is None:
+                return f'{key} must be set'
+        for replica in instance.get('pg_replicas') or []:
+            if not isinstance(replica, dict) or replica.get('pg_host') is None:
+                return 'pg_host must be set for every replica'
+        return ''
+
+    # Returns the instance, or None when it is invalid. The password is never logged
     def validatePgInstance(self, instance) -> dict:
-        try:
-            if instance['pg_host'] is None:
-                raise ValueError('pg_host must be set')
-            if instance['pg_port'] is None:
-                raise ValueError('pg_port must be set')
-            if instance['pg_user'] is None:
-                raise ValueError('pg_user must be set')
-            if instance['pg_password'] is None:
-                raise ValueError('pg_password must be set')
-            return instance
-        except Exception as e:
-            self.logger.warning(f'Failed to parse, dropping instance: {json.dumps(instance)}\n Error message: {e}')
+        if not isinstance(instance, dict):
+            self.logger.warning('Failed to parse, dropping instance: not a mapping')
+            return None
+        error = self.getInstanceError(instance)
+        if error:
+            self.logger.warning(f"Failed to parse, dropping instance {instance.get('pg_host')}:"
+                                f"{instance.get('pg_port')}/{instance.get('pg_db', '')}\n Error message: {error}")
             return None
+        return instance
 
     # Initialize logger
     def createLogger(self) -> logging.Logger:
@@ -0,0 +1,40 @@
+"""
+This module renders samples in prometheus text exposition format
+"""
+import math
+from collections import namedtuple
+
+# samples of a histogram share the family name of the histogram, other samples are their own family
+Sample = namedtuple('Sample', ['name', 'labels', 'value', 'type', 'help', 'family'], defaults=[None])
+
+
+def formatValue(value) -> str:
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+
+def escapeLabelValue(value) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def escapeHelp(value) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n')
+
+
+# Renders samples in prometheus text exposition format
+def renderExposition(samples) -> str:
+    families = {}
+    for sample in samples:
+        families.setdefault(sample.family or sample.name, []).append(sample)
+    lines = []
+    for name, family in families.items():
+        lines.append(f'# HELP {name} {escapeHelp(family[0].help)}')
+        lines.append(f'# TYPE {name} {family[0].type}')
+        for sample in family:
+            labels = ','.join(f'{k}="{escapeLabelValue(v)}"' for k, v in sample.labels)
+            lines.append(f'{sample.name}{{{labels}}} {formatValue(sample.value)}' if labels else
+                         f'{sample.name} {formatValue(sample.value)}')
+    return '\n'.join(lines) + '\n'
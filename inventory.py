@@ -0,0 +1,160 @@
+"""
+This module loads large instance inventories from files: a JSON-lines file with one instance per line, a YAML or
+JSON list, or a directory with one file per instance (or per list of instances). Entries are read one by one and
+validated in bulk. When enabled, the parsed inventory is cached next to it so a restart with an unchanged inventory
+skips parsing
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+import yaml
+
+INVENTORY_EXTENSIONS = ('.jsonl', '.json', '.yml', '.yaml')
+CACHE_VERSION = 1
+MAX_REPORTED_ERRORS = 5
+
+logger = logging.getLogger(__name__)
+
+
+# Returns the files an inventory path consists of, sorted
+def getFiles(path) -> list:
+    if not os.path.isdir(path):
+        return [path]
+    return sorted(os.path.join(path, name) for name in os.listdir(path)
+                  if name.endswith(INVENTORY_EXTENSIONS) and not name.startswith('.'))
+
+
+# Returns (path, modification time, size) of every file of the given paths, missing and empty paths are skipped.
+# Directories contribute their own entry and one per inventory file, so added, removed and edited files all count
+def getSourceState(paths) -> list:
+    state = []
+    for path in paths:
+        if not path or not os.path.exists(path):
+            continue
+        files = [path] + getFiles(path) if os.path.isdir(path) else [path]
+        for file in files:
+            stat = os.stat(file)
+            state.append((file, stat.st_mtime_ns, stat.st_size))
+    return state
+
+
+# Yields (location, entry) for every entry of an inventory file, JSON-lines files are read a line at a time and
+# a line that is not valid JSON yields its error instead of the entry
+def readFile(path):
+    with open(path) as f:
+        if path.endswith('.jsonl'):
+            for number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    yield f'{path}:{number}', json.loads(line)
+                except ValueError as e:
+                    yield f'{path}:{number}', e
+            return
+        if path.endswith('.json'):
+            data = json.load(f)
+        else:
+            data = yaml.load(f, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+    if isinstance(data, dict) and 'instances' in data:
+        data = data['instances']
+    if isinstance(data, list):
+        for number, entry in enumerate(data, 1):
+            yield f'{path}[{number}]', entry
+    elif data is not None:
+        yield path, data
+
+
+# Reads and validates all entries of an inventory path. validate returns an error message for an invalid entry
+# or an empty string. Returns the valid instances and a "location: error" string for every invalid one
+def parseInventory(path, validate) -> tuple:
+    instances = []
+    errors = []
+    for file in getFiles(path):
+        try:
+            for location, entry in readFile(file):
+                if isinstance(entry, Exception):
+                    error = str(entry)
+                else:
+                    error = validate(entry) if isinstance(entry, dict) else 'entry is not a mapping'
+                if error:
+                    errors.append(f'{location}: {error}')
+                else:
+                    instances.append(entry)
+        except (OSError, ValueError, yaml.YAMLError) as e:
+            errors.append(f'{file}: {e}')
+    return instances, errors
+
+
+# Returns a hash of the content of all files of an inventory path
+def getContentHash(path) -> str:
+    digest = hashlib.sha1()
+    for file in getFiles(path):
+        digest.update(file.encode() + b'\0')
+        with open(file, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Returns the cache path of an inventory: a hidden file next to it, and outside of it when it is a directory.
+# The cache holds the passwords of the inventory, so it stays with the files that already hold them
+def getCachePath(path) -> str:
+    path = os.path.abspath(path).rstrip(os.sep)
+    return os.path.join(os.path.dirname(path), f'.{os.path.basename(path)}.cache.json')
+
+
+def readCache(cachePath) -> dict:
+    try:
+        with open(cachePath) as f:
+            cache = json.load(f)
+        return cache if cache.get('version') == CACHE_VERSION else {}
+    except (OSError, ValueError):
+        return {}
+
+
+# Writes the cache readable by the owner only, it holds passwords. The temporary file gets a new random name
+# and is created exclusively, so an existing file or link in its place is never written through
+def writeCache(cachePath, cache) -> None:
+    tmpPath = None
+    try:
+        fd, tmpPath = tempfile.mkstemp(prefix=f'{os.path.basename(cachePath)}.', dir=os.path.dirname(cachePath))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmpPath, cachePath)
+    except OSError as e:
+        logger.debug(f'Failed to write inventory cache {cachePath}: {e}')
+        if tmpPath is not None and os.path.exists(tmpPath):
+            os.remove(tmpPath)
+
+
+# Loads an inventory path. With a cache path, the cached result is used when the files did not change: first by
+# modification time and size, and when those changed, by the hash of the content. Returns the valid instances and
+# the errors
+def loadInventory(path, validate, cachePath=None) -> tuple:
+    if not os.path.exists(path):
+        return [], [f'{path}: no such file or directory']
+    if cachePath is None:
+        return parseInventory(path, validate)
+    cache = readCache(cachePath)
+    state = [list(entry) for entry in getSourceState([path])]
+    if cache and cache['state'] == state:
+        return cache['instances'], cache['errors']
+    contentHash = getContentHash(path)
+    if cache and cache['hash'] == contentHash:
+        instances, errors = cache['instances'], cache['errors']
+    else:
+        instances, errors = parseInventory(path, validate)
+    writeCache(cachePath, {'version': CACHE_VERSION, 'state': state, 'hash': contentHash, 'instances': instances,
+                           'errors': errors})
+    return instances, errors
+
+
+# Returns a one line summary of the invalid entries of an inventory
+def formatErrors(errors, total) -> str:
+    summary = '; '.join(errors[:MAX_REPORTED_ERRORS])
+    if len(errors) > MAX_REPORTED_ERRORS:
+        summary += f'; and {len(errors) - MAX_REPORTED_ERRORS} more'
+    return f'Dropped {len(errors)} of {total} inventory entries: {summary}'
@@ -0,0 +1,55 @@
+"""
+This module assigns the ports of the exporters from a fixed range. Every receiver id starts probing at a port
+derived from a hash of the id, so the same inventory gets the same ports every time, and all ports are checked
+and reserved in a single pass before any exporter starts
+"""
+import hashlib
+import socket
+from contextlib import closing
+
+DEFAULT_PORT_RANGE_START = 20000
+DEFAULT_PORT_RANGE_SIZE = 10000
+
+
+# Returns whether nothing listens on a port, the exporters bind with SO_REUSEADDR so the check does too
+def isPortFree(port) -> bool:
+    with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as s:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            s.bind(('', port))
+        except OSError:
+            return False
+        return True
+
+
+class PortAllocator:
+    def __init__(self, start=DEFAULT_PORT_RANGE_START, size=DEFAULT_PORT_RANGE_SIZE, isFree=isPortFree) -> None:
+        self.start = int(start)
+        self.size = int(size)
+        if self.start < 1024 or self.size < 1 or self.start + self.size > 65536:
+            raise ValueError(f'Invalid port range {self.start}-{self.start + self.size - 1}')
+        self.isFree = isFree
+
+    def getPreferredPort(self, receiverId) -> int:
+        return self.start + int(hashlib.sha1(receiverId.encode()).hexdigest(), 16) % self.size
+
+    # Returns a port for every receiver id. Ports in reserved (receiver id -> port) belong to processes that
+    # already run, they are kept for their ids and never given to another id. Other ids take the first free port
+    # from their preferred port on, ids are handled in sorted order so the result does not depend on the order
+    # of the inventory
+    def allocate(self, receiverIds, reserved=None) -> dict:
+        reserved = reserved or {}
+        ports = {receiverId: reserved[receiverId] for receiverId in receiverIds if receiverId in reserved}
+        taken = set(reserved.values())
+        for receiverId in sorted(set(receiverIds) - set(ports)):
+            preferred = self.getPreferredPort(receiverId)
+            for offset in range(self.size):
+                port = self.start + (preferred - self.start + offset) % self.size
+                if port not in taken:
+                    taken.add(port)
+                    if self.isFree(port):
+                        ports[receiverId] = port
+                        break
+            else:
+                raise ValueError(f'No free port left in {self.start}-{self.start + self.size - 1} for {receiverId}')
+        return ports
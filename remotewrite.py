@@ -0,0 +1,391 @@
+"""
+This module ships samples straight to a prometheus remote write endpoint, so the native engine does not need
+the collector to render, parse and encode them again
+"""
+import collections
+import contextlib
+import http.client
+import logging
+import os
+import queue
+import struct
+import threading
+import time
+from urllib.parse import urlsplit
+
+from exposition import Sample
+from selfmetrics import Counter
+
+try:
+    import snappy
+except ImportError:
+    snappy = None
+
+DEFAULT_BATCH_SIZE = 5000
+DEFAULT_BATCH_INTERVAL = 5
+DEFAULT_CONNECTIONS = 1
+DEFAULT_QUEUE_DIR = './remote-write-queue'
+DEFAULT_QUEUE_MAX_MB = 256
+# batches of samples the workers may fall behind in memory before the oldest samples are dropped
+MEMORY_QUEUE_BATCHES = 10
+MAX_RETRIES = 5
+RETRY_INITIAL_INTERVAL = 0.5
+RETRY_MAX_INTERVAL = 30
+SNAPPY_MAX_LITERAL = 65536
+
+_STOP = object()
+
+
+def encodeVarint(value) -> bytes:
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+# Encodes a length delimited protobuf field
+def encodeField(number, payload) -> bytes:
+    return encodeVarint(number << 3 | 2) + encodeVarint(len(payload)) + payload
+
+
+# Encodes a prometheus.WriteRequest, series is a list of (labels, [(value, timestamp in ms)]) where labels are
+# (name, value) pairs sorted by name
+def encodeWriteRequest(series) -> bytes:
+    out = bytearray()
+    for labels, points in series:
+        timeSeries = bytearray()
+        for name, value in labels:
+            timeSeries += encodeField(1, encodeField(1, name.encode()) + encodeField(2, value.encode()))
+        for value, timestamp in points:
+            timeSeries += encodeField(2, b'\x09' + struct.pack('<d', value) + b'\x10' + encodeVarint(timestamp))
+        out += encodeField(1, bytes(timeSeries))
+    return bytes(out)
+
+
+# Compresses with the snappy block format remote write expects. Without python-snappy the data is written as
+# uncompressed literals, which is valid snappy but larger
+def compressBlock(data) -> bytes:
+    if snappy is not None:
+        return snappy.compress(data)
+    out = bytearray(encodeVarint(len(data)))
+    for i in range(0, len(data), SNAPPY_MAX_LITERAL):
+        chunk = data[i:i + SNAPPY_MAX_LITERAL]
+        length = len(chunk) - 1
+        if length < 60:
+            out.append(length << 2)
+        elif length < 256:
+            out += bytes([60 << 2, length])
+        else:
+            out += bytes([61 << 2]) + length.to_bytes(2, 'little')
+        out += chunk
+    return bytes(out)
+
+
+# Keeps the batches that could not be sent in files, oldest first. When the size limit is reached the oldest
+# batches are dropped, so the freshest samples are kept. Batches left by a previous run are sent first
+class DiskQueue:
+    def __init__(self, directory, maxBytes) -> None:
+        self.directory = directory
+        self.maxBytes = int(maxBytes)
+        self.lock = threading.Lock()
+        # (path, samples, size) of every batch, oldest first
+        self.entries = collections.deque()
+        self.bytes = 0
+        self.samples = 0
+        self.droppedSamples = 0
+        os.makedirs(directory, exist_ok=True)
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith('.snappy'):
+                continue
+            path = os.path.join(directory, name)
+            self.append(path, int(name[:-len('.snappy')].split('-')[1]), os.path.getsize(path))
+        self.sequence = int(os.path.basename(self.entries[-1][0]).split('-')[0]) + 1 if self.entries else 0
+
+    def append(self, path, samples, size) -> None:
+        self.entries.append((path, samples, size))
+        self.bytes += size
+        self.samples += samples
+
+    def dropOldest(self) -> None:
+        path, samples, size = self.entries.popleft()
+        self.bytes -= size
+        self.samples -= samples
+        self.droppedSamples += samples
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+
+    def put(self, body, samples) -> None:
+        with self.lock:
+            if len(body) > self.maxBytes:
+                self.droppedSamples += samples
+                return
+            while self.bytes + len(body) > self.maxBytes:
+                self.dropOldest()
+            path = os.path.join(self.directory, f'{self.sequence:020d}-{samples}.snappy')
+            self.sequence += 1
+            with open(f'{path}.tmp', 'wb') as f:
+                f.write(body)
+            os.replace(f'{path}.tmp', path)
+            self.append(path, samples, len(body))
+
+    # Returns the path, sample count and content of the oldest batch, or None when the queue is empty
+    def peek(self):
+        while True:
+            with self.lock:
+                if not self.entries:
+                    return None
+                path, samples, _ = self.entries[0]
+            try:
+                with open(path, 'rb') as f:
+                    return path, samples, f.read()
+            except FileNotFoundError:
+                # dropped by a put since
+                continue
+
+    def remove(self, path) -> None:
+        with self.lock:
+            for entry in self.entries:
+                if entry[0] == path:
+                    self.entries.remove(entry)
+                    self.bytes -= entry[2]
+                    self.samples -= entry[1]
+                    break
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+
+
+# Batches samples from any thread and posts them over long lived connections, one worker thread per connection.
+# With a disk queue, batches that fail are queued and sent in order once the endpoint recovers, while new batches
+# wait behind them, so a slow endpoint never grows the memory of the process
+class RemoteWriter:
+    def __init__(self, url, headers=None, externalLabels=(), batchSize=DEFAULT_BATCH_SIZE,
+                 batchInterval=DEFAULT_BATCH_INTERVAL, timeout=30, connections=DEFAULT_CONNECTIONS, diskQueue=None,
+                 retryInterval=RETRY_INITIAL_INTERVAL, maxQueueSamples=None) -> None:
+        parsed = urlsplit(url)
+        self.https = parsed.scheme == 'https'
+        self.host = parsed.hostname
+        self.port = parsed.port or (443 if self.https else 80)
+        self.path = parsed.path or '/'
+        self.headers = {
+            'Content-Encoding': 'snappy',
+            'Content-Type': 'application/x-protobuf',
+            'User-Agent': 'logzio-postgres-collector',
+            'X-Prometheus-Remote-Write-Version': '0.1.0',
+        }
+        self.headers.update(headers or {})
+        self.externalLabels = tuple(externalLabels)
+        self.batchSize = int(batchSize)
+        self.batchInterval = float(batchInterval)
+        self.timeout = float(timeout)
+        self.connections = int(connections)
+        self.diskQueue = diskQueue
+        self.retryInterval = float(retryInterval)
+        self.retryDelay = self.retryInterval
+        self.retryAt = 0.0
+        self.queue = queue.Queue()
+        self.maxQueueSamples = int(maxQueueSamples or self.batchSize * MEMORY_QUEUE_BATCHES)
+        self.queuedSamples = 0
+        self.workers = []
+        self.lock = threading.Lock()
+        self.drainLock = threading.Lock()
+        self.samplesSent = Counter('pg_collector_remote_write_samples_total', 'Samples sent to remote write')
+        self.bytesSent = Counter('pg_collector_remote_write_bytes_total', 'Compressed bytes sent to remote write')
+        self.requests = Counter('pg_collector_remote_write_requests_total', 'Remote write requests by result')
+        self.dropped = Counter('pg_collector_remote_write_dropped_samples_total', 'Samples dropped by reason')
+        self.logger = logging.getLogger(__name__)
+        if snappy is None:
+            self.logger.warning('python-snappy is not installed, remote write requests are sent uncompressed')
+
+    def start(self) -> None:
+        for i in range(self.connections):
+            worker = threading.Thread(target=self.runWorker, name=f'remote-write-{i}', daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    # Queues samples for sending, never blocks the caller. While the workers are behind by more than
+    # maxQueueSamples, the oldest pushes are dropped, like the oldest batches of the disk queue
+    def push(self, samples, timestamp=None) -> None:
+        timestamp = int((timestamp or time.time()) * 1000)
+        series = []
+        for sample in samples:
+            labels = tuple(sorted((('__name__', sample.name),) + tuple(sample.labels) + self.externalLabels))
+            series.append((labels, [(float(sample.value), timestamp)]))
+        if not series:
+            return
+        with self.lock:
+            while self.queuedSamples and self.queuedSamples + len(series) > self.maxQueueSamples:
+                try:
+                    oldest = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if oldest is _STOP:
+                    self.queue.put(_STOP)
+                    break
+                self.queuedSamples -= len(oldest)
+                self.dropped.inc((('reason', 'memory_full'),), len(oldest))
+            self.queuedSamples += len(series)
+            self.queue.put(series)
+
+    def runWorker(self) -> None:
+        connection = None
+        batch = []
+        deadline = None
+        while True:
+            waits = []
+            if batch:
+                waits.append(deadline - time.monotonic())
+            if self.diskQueue is not None and self.diskQueue.samples:
+                waits.append(self.retryAt - time.monotonic())
+            try:
+                item = self.queue.get(timeout=max(min(waits), 0) if waits else None)
+            except queue.Empty:
+                item = None
+            if item is _STOP:
+                for i in range(0, len(batch), self.batchSize):
+                    connection = self.flush(connection, batch[i:i + self.batchSize])
+                if connection is not None:
+                    connection.close()
+                return
+            if item is not None:
+                with self.lock:
+                    self.queuedSamples -= len(item)
+                batch.extend(item)
+                deadline = deadline or time.monotonic() + self.batchInterval
+            if batch and (len(batch) >= self.batchSize or time.monotonic() >= deadline):
+                for i in range(0, len(batch), self.batchSize):
+                    connection = self.flush(connection, batch[i:i + self.batchSize])
+                batch = []
+                deadline = None
+            elif self.diskQueue is not None and self.diskQueue.samples:
+                connection = self.drain(connection)
+
+    def createConnection(self) -> http.client.HTTPConnection:
+        if self.https:
+            return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def countRequest(self, result, samples=0, size=0) -> None:
+        with self.lock:
+            self.requests.inc((('result', result),))
+            if samples:
+                self.samplesSent.inc((), samples)
+                self.bytesSent.inc((), size)
+
+    def countDropped(self, reason, samples) -> None:
+        with self.lock:
+            self.dropped.inc((('reason', reason),), samples)
+
+    # Posts a batch once, reusing the connection while the server keeps it open. Returns the connection to use
+    # for the next batch and the result: success, rejected (the batch is dropped) or retry
+    def post(self, connection, body, samples) -> tuple:
+        try:
+            connection = connection or self.createConnection()
+            connection.request('POST', self.path, body, self.headers)
+            response = connection.getresponse()
+            response.read()
+            if 200 <= response.status < 300:
+                self.countRequest('success', samples, len(body))
+                self.retryDelay = self.retryInterval
+                return connection, 'success'
+            if 400 <= response.status < 500 and response.status != 429:
+                self.logger.error(f'Remote write rejected {samples} samples with status {response.status}')
+                self.countRequest('rejected')
+                self.countDropped('rejected', samples)
+                return connection, 'rejected'
+            self.logger.warning(f'Remote write failed with status {response.status}')
+        except (OSError, http.client.HTTPException) as e:
+            self.logger.warning(f'Remote write failed: {e}')
+            if connection is not None:
+                connection.close()
+            connection = None
+        self.countRequest('retry')
+        return connection, 'retry'
+
+    # Waits before the next attempt, longer after every failure
+    def backoff(self) -> None:
+        with self.lock:
+            self.retryAt = time.monotonic() + self.retryDelay
+            self.retryDelay = min(self.retryDelay * 2, RETRY_MAX_INTERVAL)
+
+    # Sends a batch. Without a disk queue it is retried with backoff and dropped after MAX_RETRIES attempts,
+    # with one it is queued when it fails or when older batches are still waiting
+    def flush(self, connection, series) -> http.client.HTTPConnection:
+        body = compressBlock(encodeWriteRequest(series))
+        if self.diskQueue is None:
+            for attempt in range(MAX_RETRIES):
+                connection, result = self.post(connection, body, len(series))
+                if result != 'retry':
+                    return connection
+                time.sleep(min(self.retryInterval * 2 ** attempt, RETRY_MAX_INTERVAL))
+            self.logger.error(f'Dropping {len(series)} samples after {MAX_RETRIES} failed remote write attempts')
+            self.countDropped('retries_exhausted', len(series))
+            return connection
+        if not self.diskQueue.samples and time.monotonic() >= self.retryAt:
+            connection, result = self.post(connection, body, len(series))
+            if result != 'retry':
+                return connection
+            self.backoff()
+        self.diskQueue.put(body, len(series))
+        return self.drain(connection)
+
+    # Sends the queued batches oldest first until the queue is empty or a batch fails, one worker at a time
+    def drain(self, connection) -> http.client.HTTPConnection:
+        if not self.drainLock.acquire(blocking=False):
+            return connection
+        try:
+            while time.monotonic() >= self.retryAt:
+                entry = self.diskQueue.peek()
+                if entry is None:
+                    break
+                path, samples, body = entry
+                connection, result = self.post(connection, body, samples)
+                if result == 'retry':
+                    self.backoff()
+                    break
+                self.diskQueue.remove(path)
+        finally:
+            self.drainLock.release()
+        return connection
+
+    # Sends what is queued in memory and stops the workers, batches that still fail stay in the disk queue
+    def close(self, timeout=None) -> None:
+        for _ in self.workers:
+            self.queue.put(_STOP)
+        for worker in self.workers:
+            worker.join(timeout)
+        self.workers = []
+
+    def samples(self) -> list:
+        with self.lock:
+            samples = self.samplesSent.samples() + self.bytesSent.samples() + self.requests.samples()
+            dropped = dict(self.dropped.series)
+            samples.append(Sample('pg_collector_remote_write_memory_queue_samples', (), float(self.queuedSamples),
+                                  'gauge', 'Samples waiting in memory for a remote write worker'))
+        if self.diskQueue is not None:
+            if self.diskQueue.droppedSamples:
+                dropped[(('reason', 'queue_full'),)] = float(self.diskQueue.droppedSamples)
+            samples.append(Sample('pg_collector_remote_write_queue_samples', (), float(self.diskQueue.samples),
+                                  'gauge', 'Samples waiting in the remote write disk queue'))
+            samples.append(Sample('pg_collector_remote_write_queue_bytes', (), float(self.diskQueue.bytes),
+                                  'gauge', 'Size of the remote write disk queue'))
+        samples.extend(Sample(self.dropped.name, labels, value, 'counter', self.dropped.help)
+                       for labels, value in dropped.items())
+        return samples
+
+
+# Creates a writer to the logz.io listener from the collector configuration
+def createRemoteWriter(config) -> RemoteWriter:
+    queueDir = config.otel.get('remote_write_queue_dir', DEFAULT_QUEUE_DIR)
+    diskQueue = None
+    if queueDir:
+        diskQueue = DiskQueue(queueDir, config.otel.get('remote_write_queue_max_mb', DEFAULT_QUEUE_MAX_MB) * 2 ** 20)
+    return RemoteWriter(config.getListenerUrl(),
+                        headers={'Authorization': f"Bearer {config.otel['token']}"},
+                        externalLabels=(('p8s_logzio_name', config.otel['p8s_logzio_name']),),
+                        batchSize=config.otel.get('remote_write_batch_size', DEFAULT_BATCH_SIZE),
+                        batchInterval=config.otel.get('remote_write_batch_interval', DEFAULT_BATCH_INTERVAL),
+                        timeout=config.otel['remote_timeout'],
+                        connections=config.otel.get('remote_write_connections', DEFAULT_CONNECTIONS),
+                        diskQueue=diskQueue)
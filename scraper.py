@@ -0,0 +1,645 @@
+"""
+This module is a native scrape engine, it runs the queries from the queries directory against the postgres
+instances over asyncio and serves the results in prometheus exposition format
+"""
+import asyncio
+import contextlib
+import datetime
+import functools
+import hashlib
+import logging
+import math
+import os
+import time
+
+import yaml
+from config import Config
+from exposition import Sample, renderExposition
+import inventory
+from remotewrite import createRemoteWriter
+from selfmetrics import SelfMetrics
+from transforms import QueryTransform, getLabelColumns
+
+DEFAULT_QUERIES_PATH = 'queries/'
+DEFAULT_POOL_SIZE = 2
+DEFAULT_DISCOVERY_INTERVAL = 300
+# seconds an idle connection stays open, the engine keeps it for at least two scrape intervals so every scrape
+# reuses the connections of the previous one
+DEFAULT_IDLE_LIFETIME = 300.0
+# max connections a host with pg_discover_databases keeps open over all its databases between scrapes
+DEFAULT_DISCOVERY_MAX_CONNECTIONS = 10
+# seconds a replica that failed is skipped before queries are routed to it again
+REPLICA_RETRY_INTERVAL = 60
+# round trip that tells whether the instance answers, a cached pool says nothing about it
+PING_QUERY = 'SELECT 1'
+DISCOVER_DATABASES_QUERY = 'SELECT datname FROM pg_database WHERE datallowconn AND NOT datistemplate'
+METRIC_TYPES = {'COUNTER': 'counter', 'GAUGE': 'gauge'}
+# sqlstate prefixes of errors that mean a node is unavailable rather than that the query failed: connection
+# exceptions, shutdowns, cannot connect now and too many connections
+NODE_FAILURE_SQLSTATES = ('08', '57P', '53300')
+# sqlstates of queries the server cancelled: query_canceled is raised by statement_timeout
+TIMEOUT_SQLSTATES = {'57014': 'statement', '55P03': 'lock'}
+DEFAULT_MAX_INTERVAL_FACTOR = 8
+# a query that runs this share of its time budget gets its interval doubled, and halved again once it runs
+# below the fast share
+SLOW_QUERY_RATIO = 0.8
+FAST_QUERY_RATIO = 0.5
+
+# Loads a queries file, or every yaml file in a queries directory, in postgres exporter format
+def loadQueries(path) -> dict:
+    if os.path.isdir(path):
+        files = sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith(('.yml', '.yaml')))
+    else:
+        files = [path]
+    queries = {}
+    for file in files:
+        with open(file) as f:
+            queries.update(yaml.safe_load(f) or {})
+    return queries
+
+
+# Returns the metric columns of a query block as (column, usage, description) tuples
+def getQueryColumns(queryDef) -> list:
+    columns = []
+    for metric in queryDef.get('metrics', []):
+        for column, settings in metric.items():
+            columns.append((column, settings.get('usage', '').upper(), settings.get('description', '')))
+    return columns
+
+
+# Converts a value returned by postgres to a sample value
+def toSampleValue(value) -> float:
+    if value is None:
+        return math.nan
+    if isinstance(value, datetime.datetime):
+        return value.timestamp()
+    if isinstance(value, datetime.timedelta):
+        return value.total_seconds()
+    return float(value)
+
+
+# Returns the labels attached to every sample of an instance, the same way postgres exporter does. Instances
+# that list one database of a host get it as datname, so several databases of the same host do not collide
+def getConstLabels(instance) -> tuple:
+    labels = [('server', f"{instance['pg_host']}:{instance['pg_port']}")]
+    if instance.get('pg_db') and not instance.get('pg_discover_databases', False):
+        labels.append(('datname', str(instance['pg_db'])))
+    for label in instance.get('pg_labels') or []:
+        for k, v in label.items():
+            labels.append((k, str(v)))
+    return tuple(labels)
+
+
+# Turns the rows of a query into samples, LABEL columns become labels of every metric column in the row
+def rowsToSamples(namespace, queryDef, rows, constLabels) -> list:
+    columns = getQueryColumns(queryDef)
+    labelColumns = [column for column, usage, _ in columns if usage == 'LABEL']
+    samples = []
+    for row in rows:
+        labels = constLabels + tuple((c, '' if row.get(c) is None else str(row[c])) for c in labelColumns)
+        for column, usage, description in columns:
+            if usage in METRIC_TYPES and column in row:
+                samples.append(Sample(f'{namespace}_{column}', labels, toSampleValue(row[column]),
+                                      METRIC_TYPES[usage], description))
+    return samples
+
+
+# Returns whether an error means the node could not run the query at all, so another node should be tried.
+# Queries the server cancelled for their statement or lock timeout are query errors, the primary must not get
+# the scan that was too slow for a replica
+def isNodeFailure(e) -> bool:
+    if getattr(e, 'sqlstate', None) in TIMEOUT_SQLSTATES:
+        return False
+    if isinstance(e, (OSError, asyncio.TimeoutError)):
+        return True
+    return str(getattr(e, 'sqlstate', None) or '').startswith(NODE_FAILURE_SQLSTATES)
+
+
+# Opens a connection pool to an instance, asyncpg is only needed when the native engine is used.
+# Pools of discovered databases open connections on demand, the scraper caps the connections of the whole host.
+# sessionSettings are set on every connection, such as the default statement_timeout and lock_timeout
+async def createPool(instance, poolSize=DEFAULT_POOL_SIZE, sessionSettings=None, idleLifetime=DEFAULT_IDLE_LIFETIME):
+    import asyncpg
+    discover = instance.get('pg_discover_databases', False)
+    return await asyncpg.create_pool(host=instance['pg_host'], port=int(instance['pg_port']),
+                                     user=instance['pg_user'], password=str(instance['pg_password']),
+                                     database=instance.get('pg_db', 'postgres'), min_size=0 if discover else 1,
+                                     max_size=poolSize, max_inactive_connection_lifetime=idleLifetime,
+                                     init=createSessionInit(sessionSettings) if sessionSettings else None)
+
+
+# Returns the pool init callback that sets sessionSettings on a new connection. They are set with SET instead of
+# being sent as startup parameters, which PgBouncer rejects unless ignore_startup_parameters lists them
+def createSessionInit(sessionSettings):
+    async def init(connection) -> None:
+        for name, value in sessionSettings.items():
+            await connection.execute(f'SET {name} = {value}')
+    return init
+
+
+# Returns the connections a pool holds open
+def getPoolConnections(pool) -> int:
+    return pool.get_size() if hasattr(pool, 'get_size') else 1
+
+
+class InstanceScraper:
+    def __init__(self, instance, queries, connect, clock=time.monotonic, poolSize=DEFAULT_POOL_SIZE,
+                 discoveryInterval=DEFAULT_DISCOVERY_INTERVAL, metrics=None, scrapeInterval=0, queryBudget=0,
+                 maxIntervalFactor=DEFAULT_MAX_INTERVAL_FACTOR,
+                 maxConnections=DEFAULT_DISCOVERY_MAX_CONNECTIONS) -> None:
+        self.instance = instance
+        self.queries = queries
+        self.metrics = metrics or SelfMetrics()
+        self.connect = connect
+        self.clock = clock
+        self.key = Config.getInstanceKey(instance)
+        self.constLabels = getConstLabels(instance)
+        # the configured database runs the cluster wide (master) queries and the discovery
+        self.database = instance.get('pg_db', 'postgres')
+        self.discover = bool(instance.get('pg_discover_databases', False))
+        self.excludedDatabases = set(instance.get('pg_exclude_databases') or [])
+        self.discoveryInterval = float(discoveryInterval)
+        self.lastDiscovery = None
+        self.databases = [self.database]
+        # node 0 is the primary, replicas inherit the settings they do not override
+        primary = {k: v for k, v in instance.items() if k != 'pg_replicas'}
+        self.nodes = [instance] + [dict(primary, **replica) for replica in instance.get('pg_replicas') or []]
+        self.replicaDownUntil = {}
+        self.nextReplica = 0
+        # caps the queries running at once over all the database pools of the host
+        self.connections = asyncio.Semaphore(poolSize) if self.discover else None
+        # caps the connections the database pools of the host keep open between scrapes
+        self.maxConnections = max(int(maxConnections), 1)
+        # pools by node and database, least recently used first
+        self.pools = {}
+        # transforms keep state, so there is one per query per database
+        self.transforms = {}
+        # last run time and samples of queries with their own interval, by query and database
+        self.cache = {}
+        # interval of queries without their own interval, and the seconds a query may run when it does not set
+        # statement_timeout. Queries that run close to their budget get their interval stretched up to the max factor
+        self.scrapeInterval = float(scrapeInterval)
+        self.queryBudget = float(queryBudget)
+        self.maxIntervalFactor = max(int(maxIntervalFactor), 1)
+        # interval factors of the stretched queries and the last run time of every query, by query and database
+        self.intervalFactors = {}
+        self.lastRun = {}
+        # whether the last scrape could connect
+        self.up = False
+        self.logger = logging.getLogger(__name__)
+
+    # Returns the long lived pool of a database on a node of the instance, connecting on first use
+    async def getPool(self, database=None, node=0):
+        key = (node, database or self.database)
+        if key in self.pools:
+            self.pools[key] = self.pools.pop(key)
+        else:
+            self.pools[key] = await self.connect(dict(self.nodes[node], pg_db=key[1]))
+        return self.pools[key]
+
+    # Closes the least recently used pools of a host with discovered databases while they hold more connections
+    # than allowed, the pool of the configured database is kept
+    async def trimPools(self) -> None:
+        if not self.discover:
+            return
+        connections = sum(getPoolConnections(pool) for pool in self.pools.values())
+        for key in list(self.pools):
+            if connections <= self.maxConnections:
+                break
+            if key == (0, self.database):
+                continue
+            pool = self.pools.pop(key)
+            connections -= getPoolConnections(pool)
+            await pool.close()
+
+    # Returns the nodes a query should try in order. Replica queries are balanced over the healthy replicas
+    # and fall back to the primary, all other queries run on the primary
+    def getRoute(self, queryDef, now) -> list:
+        if queryDef.get('route', 'primary') != 'replica':
+            return [0]
+        healthy = [node for node in range(1, len(self.nodes)) if self.replicaDownUntil.get(node, 0) <= now]
+        if healthy:
+            self.nextReplica = (self.nextReplica + 1) % len(healthy)
+            healthy = healthy[self.nextReplica:] + healthy[:self.nextReplica]
+        return healthy + [0]
+
+    # Runs a query on the first node of its route that answers. A replica that cannot be reached is skipped for a
+    # while, errors of the query itself fail the query on any node, they would fail on the next node too
+    async def fetch(self, name, queryDef, database) -> list:
+        for node in self.getRoute(queryDef, self.clock()):
+            try:
+                pool = await self.getPool(database, node)
+            except Exception as e:
+                if node == 0:
+                    raise
+                self.skipReplica(name, node, e)
+                continue
+            try:
+                async with self.connections or contextlib.nullcontext():
+                    return await self.execute(pool, queryDef)
+            except Exception as e:
+                if node == 0 or not isNodeFailure(e):
+                    raise
+                self.skipReplica(name, node, e)
+
+    def skipReplica(self, name, node, e) -> None:
+        self.logger.warning(f'Query {name} failed on replica {Config.getInstanceKey(self.nodes[node])} of '
+                            f'{self.key}, trying the next node: {e}')
+        self.replicaDownUntil[node] = self.clock() + REPLICA_RETRY_INTERVAL
+        self.metrics.replicaFailovers.inc((('target', self.key),))
+
+    # Runs a query, the statement_timeout and lock_timeout of the query block apply to a transaction of its own
+    @staticmethod
+    async def execute(pool, queryDef) -> list:
+        sessionSettings = Config.getSessionSettings(queryDef, prefix='')
+        if not sessionSettings:
+            return await pool.fetch(queryDef['query'])
+        async with pool.acquire() as connection:
+            async with connection.transaction(readonly=True):
+                for name, value in sessionSettings.items():
+                    await connection.execute(f'SET LOCAL {name} = {value}')
+                return await connection.fetch(queryDef['query'])
+
+    # Refreshes the databases of the host once every discovery interval, pools of dropped databases are closed
+    async def discoverDatabases(self, now) -> None:
+        if not self.discover or (self.lastDiscovery is not None and now - self.lastDiscovery < self.discoveryInterval):
+            return
+        try:
+            pool = await self.getPool()
+            rows = await pool.fetch(DISCOVER_DATABASES_QUERY)
+        except Exception as e:
+            self.logger.warning(f'Failed to discover databases of {self.key}: {e}')
+            return
+        discovered = sorted(row['datname'] for row in rows if row['datname'] not in self.excludedDatabases)
+        databases = [self.database] + [database for database in discovered if database != self.database]
+        for key in [key for key in self.pools if key[1] not in databases]:
+            pool = self.pools.pop(key)
+            await pool.close()
+        for job in [job for job in self.transforms if job[1] not in databases]:
+            self.transforms.pop(job)
+            self.cache.pop(job, None)
+            self.intervalFactors.pop(job, None)
+            self.lastRun.pop(job, None)
+        if databases != self.databases:
+            self.logger.info(f'Scraping {len(databases)} databases of {self.key}')
+        self.databases = databases
+        self.lastDiscovery = now
+
+    # Returns all (query, database) pairs, cluster wide queries run only on the configured database
+    def getJobs(self) -> list:
+        jobs = []
+        for name, queryDef in self.queries.items():
+            databases = [self.database] if queryDef.get('master', False) else self.databases
+            jobs.extend((name, database) for database in databases)
+        return jobs
+
+    async def runQuery(self, name, database) -> list:
+        queryDef = self.queries[name]
+        start = time.perf_counter()
+        try:
+            rows = await self.fetch(name, queryDef, database)
+        except Exception as e:
+            # failed queries cost time too, the ones that time out the most
+            self.metrics.queryTime.inc((('target', self.key), ('query', name)), time.perf_counter() - start)
+            self.metrics.queryErrors.inc((('target', self.key), ('query', name)))
+            reason = TIMEOUT_SQLSTATES.get(getattr(e, 'sqlstate', None))
+            if reason is not None:
+                self.metrics.queryTimeouts.inc((('target', self.key), ('query', name), ('reason', reason)))
+                self.adaptInterval((name, database), time.perf_counter() - start, timedOut=True)
+            raise
+        duration = time.perf_counter() - start
+        self.adaptInterval((name, database), duration)
+        if (name, database) not in self.transforms:
+            self.transforms[(name, database)] = QueryTransform(queryDef)
+        transform = self.transforms[(name, database)]
+        rowsCount = len(rows)
+        rows = transform.apply([dict(row) for row in rows])
+        if transform.droppedSeries:
+            self.logger.warning(f'Query {name} on {self.key} exceeded {transform.cap.maxSeries} series, '
+                                f'dropped {transform.droppedSeries}')
+            self.metrics.seriesCapped.inc((('target', self.key), ('query', name)), transform.droppedSeries)
+        labels = self.constLabels
+        # results of different databases must not collide, a datname column of the query takes precedence
+        if 'datname' in getLabelColumns(queryDef):
+            labels = tuple(label for label in labels if label[0] != 'datname')
+        elif self.discover and not queryDef.get('master', False):
+            labels = labels + (('datname', database),)
+        samples = rowsToSamples(name, transform.queryDef, rows, labels)
+        self.metrics.observeQuery(self.key, name, duration, rowsCount, len(samples))
+        return samples
+
+    # Doubles the interval factor of a query that timed out or ran close to its time budget, and halves it again
+    # when the query runs well within the budget
+    def adaptInterval(self, job, duration, timedOut=False) -> None:
+        budget = float(self.queries[job[0]].get('statement_timeout') or self.queryBudget)
+        if budget <= 0 or self.maxIntervalFactor <= 1:
+            return
+        factor = self.intervalFactors.get(job, 1)
+        if timedOut or duration >= SLOW_QUERY_RATIO * budget:
+            newFactor = min(factor * 2, self.maxIntervalFactor)
+        elif duration < FAST_QUERY_RATIO * budget:
+            newFactor = max(factor // 2, 1)
+        else:
+            newFactor = factor
+        if newFactor == factor:
+            return
+        self.logger.info(f'Query {job[0]} on {self.key} database {job[1]} took {duration:.2f}s of its {budget}s '
+                         f'budget, it now runs every {newFactor} intervals')
+        if newFactor > 1:
+            self.intervalFactors[job] = newFactor
+        else:
+            self.intervalFactors.pop(job)
+        highest = max(self.intervalFactors.get((job[0], database), 1) for database in self.databases)
+        self.metrics.queryIntervalFactor.set((('target', self.key), ('query', job[0])), highest)
+
+    # Returns the jobs that should run now, queries with an interval run only when their cached result expired.
+    # Stretched queries run once every factor times their interval, or the scrape interval when they have none
+    def getDueJobs(self, now) -> list:
+        due = []
+        for job in self.getJobs():
+            interval = self.queries[job[0]].get('interval')
+            factor = self.intervalFactors.get(job, 1)
+            if factor > 1:
+                interval = factor * (float(interval) if interval is not None else self.scrapeInterval)
+                if job not in self.lastRun or now - self.lastRun[job] >= interval:
+                    due.append(job)
+            elif interval is None or job not in self.cache or now - self.cache[job][0] >= float(interval):
+                due.append(job)
+        return due
+
+    # Runs all queries concurrently, a failing query is logged and skipped. The instance is up when it answers a
+    # ping and no query lost its connection
+    async def scrape(self) -> list:
+        try:
+            pool = await self.getPool()
+            async with self.connections or contextlib.nullcontext():
+                await pool.fetch(PING_QUERY)
+        except Exception as e:
+            self.logger.warning(f'Failed to connect to {self.key}: {e}')
+            self.metrics.connectionErrors.inc((('target', self.key),))
+            self.up = False
+            return [Sample('pg_up', self.constLabels, 0.0, 'gauge', 'Whether the instance is reachable')]
+        now = self.clock()
+        await self.discoverDatabases(now)
+        jobs = self.getDueJobs(now)
+        results = await asyncio.gather(*(self.runQuery(name, database) for name, database in jobs),
+                                       return_exceptions=True)
+        await self.trimPools()
+        for job, result in zip(jobs, results):
+            self.lastRun[job] = now
+            if isinstance(result, Exception):
+                self.logger.warning(f'Query {job[0]} failed on {self.key} database {job[1]}: {result}')
+                self.cache.pop(job, None)
+            elif self.queries[job[0]].get('interval') is not None or job in self.intervalFactors:
+                self.cache[job] = (now, result)
+        results = dict(zip(jobs, results))
+        samples = []
+        for job in self.getJobs():
+            # a stretched query that failed has nothing to serve until its next run
+            result = results[job] if job in results else self.cache.get(job, (None, []))[1]
+            if not isinstance(result, Exception):
+                samples.extend(result)
+        self.up = not any(isinstance(result, Exception) and isNodeFailure(result) for result in results.values())
+        if not self.up:
+            self.logger.warning(f'Lost the connection to {self.key} during the scrape')
+            self.metrics.connectionErrors.inc((('target', self.key),))
+        samples.append(Sample('pg_up', self.constLabels, 1.0 if self.up else 0.0, 'gauge',
+                              'Whether the instance is reachable'))
+        return samples
+
+    async def close(self) -> None:
+        pools, self.pools = self.pools, {}
+        await asyncio.gather(*(pool.close() for pool in pools.values()))
+
+
+class ScrapeEngine:
+    def __init__(self, config, queries, connect=None) -> None:
+        poolSize = int(config.pg.get('pg_native_pool_size', DEFAULT_POOL_SIZE))
+        # idle connections outlive the scrape interval, so scrapes do not reconnect
+        idleLifetime = max(DEFAULT_IDLE_LIFETIME, 2 * float(config.pg['pg_scrape_interval']))
+        connect = connect or functools.partial(createPool, poolSize=poolSize, idleLifetime=idleLifetime,
+                                               sessionSettings=Config.getSessionSettings(config.pg))
+        discoveryInterval = float(config.pg.get('pg_discovery_interval', DEFAULT_DISCOVERY_INTERVAL))
+        # queries may run for the statement timeout, or for the whole scrape timeout when there is none
+        queryBudget = float(config.pg.get('pg_statement_timeout') or config.pg['pg_scrape_timeout'])
+        self.metrics = SelfMetrics()
+        self.selfMetrics = bool(config.pg.get('pg_self_metrics', True))
+        self.createScraper = functools.partial(InstanceScraper, queries=queries, connect=connect, poolSize=poolSize,
+                                               discoveryInterval=discoveryInterval, metrics=self.metrics,
+                                               scrapeInterval=float(config.pg['pg_scrape_interval']),
+                                               queryBudget=queryBudget,
+                                               maxConnections=int(config.pg.get('pg_discovery_max_connections',
+                                                                                DEFAULT_DISCOVERY_MAX_CONNECTIONS)),
+                                               maxIntervalFactor=int(config.pg.get('pg_max_interval_factor',
+                                                                                   DEFAULT_MAX_INTERVAL_FACTOR)))
+        self.scrapers = [self.createScraper(instance) for instance in config.pg['instances']]
+        self.reloadInterval = float(config.pg.get('pg_reload_interval', 0))
+        self.inventoryPath = config.pg.get('pg_inventory')
+        self.interval = float(config.pg['pg_scrape_interval'])
+        self.timeout = float(config.pg['pg_scrape_timeout'])
+        self.spread = bool(config.pg.get('pg_scrape_spread', False))
+        maxConcurrent = int(config.pg.get('pg_max_concurrent_scrapes', 0))
+        self.semaphore = asyncio.Semaphore(maxConcurrent) if maxConcurrent > 0 else None
+        # latest samples of every instance when scrapes are scheduled in the background
+        self.latest = {}
+        self.tasks = {}
+        # remote writer the scheduled results are pushed to in direct remote write mode
+        self.writer = None
+        self.inFlight = 0
+        self.peakInFlight = 0
+        self.logger = logging.getLogger(__name__)
+
+    # Scrapes a single instance, bound by the scrape timeout and by the fleet wide concurrency limit
+    async def scrapeInstance(self, scraper) -> list:
+        async with self.semaphore or contextlib.nullcontext():
+            self.inFlight += 1
+            self.peakInFlight = max(self.peakInFlight, self.inFlight)
+            start = time.perf_counter()
+            try:
+                samples = await asyncio.wait_for(scraper.scrape(), self.timeout)
+            except asyncio.TimeoutError:
+                self.metrics.observeScrape(scraper.key, 'timeout', time.perf_counter() - start)
+                raise
+            except Exception:
+                self.metrics.observeScrape(scraper.key, 'failure', time.perf_counter() - start)
+                raise
+            finally:
+                self.inFlight -= 1
+        self.metrics.observeScrape(scraper.key, 'success' if scraper.up else 'failure', time.perf_counter() - start)
+        return samples
+
+    # Scrapes all instances concurrently
+    async def collect(self) -> list:
+        results = await asyncio.gather(*(self.scrapeInstance(scraper) for scraper in self.scrapers),
+                                       return_exceptions=True)
+        samples = []
+        for scraper, result in zip(self.scrapers, results):
+            if isinstance(result, Exception):
+                self.logger.warning(f'Scrape of {scraper.key} failed: {result!r}')
+                continue
+            samples.extend(result)
+        return samples
+
+    # Returns every scraper with its start offset, instances are spread evenly over the scrape interval in an
+    # order that only depends on their keys, so the same inventory always gets the same schedule
+    def getSchedule(self) -> list:
+        ordered = sorted(self.scrapers, key=lambda scraper: hashlib.sha1(scraper.key.encode()).hexdigest())
+        return [(scraper, i * self.interval / len(ordered)) for i, scraper in enumerate(ordered)]
+
+    # Scrapes an instance once every interval starting at its offset, runs that were missed because a scrape
+    # took longer than the interval are skipped
+    async def runScheduled(self, scraper, offset) -> None:
+        loop = asyncio.get_running_loop()
+        nextRun = loop.time() + offset
+        while True:
+            await asyncio.sleep(max(nextRun - loop.time(), 0))
+            try:
+                self.latest[scraper.key] = await self.scrapeInstance(scraper)
+                if self.writer is not None:
+                    self.writer.push(self.latest[scraper.key])
+            except Exception as e:
+                self.logger.warning(f'Scrape of {scraper.key} failed: {e!r}')
+                self.latest.pop(scraper.key, None)
+            nextRun += self.interval
+            while nextRun <= loop.time():
+                nextRun += self.interval
+
+    # Returns the samples describing the engine itself, the peak is reset on every read
+    def getEngineSamples(self) -> list:
+        samples = [
+            Sample('pg_collector_scrapes_in_flight', (), float(self.inFlight), 'gauge',
+                   'Number of instance scrapes currently running'),
+            Sample('pg_collector_scrapes_in_flight_peak', (), float(self.peakInFlight), 'gauge',
+                   'Highest number of instance scrapes running at once since the previous read'),
+            Sample('pg_collector_scrape_timeout_seconds', (), self.timeout, 'gauge',
+                   'Time an instance scrape may take before it is abandoned'),
+        ]
+        self.peakInFlight = self.inFlight
+        return samples
+
+    async def getSamples(self) -> list:
+        if self.spread:
+            samples = [sample for result in self.latest.values() for sample in result]
+        else:
+            samples = await self.collect()
+        samples = samples + self.getEngineSamples()
+        if self.selfMetrics:
+            samples.extend(self.metrics.samples())
+        return samples
+
+    # Minimal http handler, serves the exposition on /metrics
+    async def handleRequest(self, reader, writer) -> None:
+        try:
+            request = await reader.readuntil(b'\r\n\r\n')
+            path = request.split(b' ')[1] if request.count(b' ') >= 2 else b''
+            if path.split(b'?')[0] == b'/metrics':
+                status, body = '200 OK', renderExposition(await self.getSamples()).encode()
+            else:
+                status, body = '404 Not Found', b'not found\n'
+            writer.write(f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                         f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            self.logger.debug(f'Dropped metrics request: {e}')
+        finally:
+            writer.close()
+
+    async def start(self, port, host='0.0.0.0'):
+        if self.spread:
+            self.scheduleScrapers()
+        return await asyncio.start_server(self.handleRequest, host, port)
+
+    # Starts the background scrapes of scrapers that do not run yet
+    def scheduleScrapers(self) -> None:
+        for scraper, offset in self.getSchedule():
+            if scraper.key not in self.tasks:
+                self.tasks[scraper.key] = asyncio.create_task(self.runScheduled(scraper, offset))
+
+    # Replaces the scraped instances, scrapers of unchanged instances keep running with their pools and state.
+    # Returns the keys of the added and removed instances
+    async def updateInstances(self, instances) -> tuple:
+        current = {scraper.key: scraper for scraper in self.scrapers}
+        scrapers = []
+        for instance in instances:
+            key = Config.getInstanceKey(instance)
+            if key in current and current[key].instance == instance:
+                scrapers.append(current.pop(key))
+            else:
+                scrapers.append(self.createScraper(instance))
+        added = [scraper.key for scraper in scrapers if scraper not in self.scrapers]
+        # whatever is left in current was removed or replaced
+        for scraper in current.values():
+            task = self.tasks.pop(scraper.key, None)
+            if task is not None:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+            self.latest.pop(scraper.key, None)
+            self.metrics.removeTarget(scraper.key)
+            await scraper.close()
+        self.scrapers = scrapers
+        if self.spread:
+            self.scheduleScrapers()
+        return added, list(current)
+
+    # Loads the configuration file again whenever it or the inventory changes, and applies its instance list
+    async def watch(self, configPath) -> None:
+        inventoryPath = self.inventoryPath
+        state = inventory.getSourceState([configPath, inventoryPath])
+        while True:
+            await asyncio.sleep(self.reloadInterval)
+            if inventory.getSourceState([configPath, inventoryPath]) == state:
+                continue
+            state = inventory.getSourceState([configPath, inventoryPath])
+            try:
+                config = Config(configPath)
+            except Exception as e:
+                self.logger.error(f'Failed to reload configuration, keeping the current instances: {e}')
+                continue
+            inventoryPath = config.pg.get('pg_inventory')
+            added, removed = await self.updateInstances(config.pg['instances'])
+            self.logger.info(f'Reloaded instances: {len(added)} added, {len(removed)} removed, '
+                             f'{len(self.scrapers) - len(added)} unchanged')
+
+    async def serve(self, port, configPath=None) -> None:
+        server = await self.start(port)
+        self.logger.info(f'Serving metrics of {len(self.scrapers)} instances on port {port}')
+        if configPath is not None and self.reloadInterval > 0:
+            asyncio.create_task(self.watch(configPath))
+        async with server:
+            await server.serve_forever()
+
+    # Scrapes every instance on its schedule and pushes the results to a remote writer instead of serving them,
+    # the samples about the engine itself are pushed once every interval
+    async def push(self, writer, configPath=None) -> None:
+        self.writer = writer
+        self.spread = True
+        self.scheduleScrapers()
+        self.logger.info(f'Pushing metrics of {len(self.scrapers)} instances to remote write')
+        if configPath is not None and self.reloadInterval > 0:
+            asyncio.create_task(self.watch(configPath))
+        while True:
+            await asyncio.sleep(self.interval)
+            samples = self.getEngineSamples() + writer.samples()
+            if self.selfMetrics:
+                samples.extend(self.metrics.samples())
+            writer.push(samples)
+
+    async def close(self) -> None:
+        for task in self.tasks.values():
+            task.cancel()
+        await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+        self.tasks = {}
+        await asyncio.gather(*(scraper.close() for scraper in self.scrapers))
+
+
+if __name__ == '__main__':
+    config = Config('./config_files/config.yml')
+    level = str(config.otel.get('logzio_log_level', 'INFO')).upper()
+    logging.getLogger().setLevel(level if level in ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'] else 'INFO')
+    engine = ScrapeEngine(config, loadQueries(DEFAULT_QUERIES_PATH))
+    if config.otel.get('remote_write_direct', False):
+        writer = createRemoteWriter(config)
+        writer.start()
+        asyncio.run(engine.push(writer, './config_files/config.yml'))
+    else:
+        asyncio.run(engine.serve(int(os.environ.get('PG_NATIVE_ENGINE_PORT', 9187)), './config_files/config.yml'))
@@ -0,0 +1,123 @@
+"""
+This module keeps the metrics the native engine reports about its own scrapes, they are served together with the
+postgres metrics so they go through the same pipeline. Histograms are kept per query over all instances, per
+instance and query there is a single cost counter, so the series grow by about one per instance and query
+"""
+import bisect
+
+from exposition import Sample
+
+DURATION_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0)
+COUNT_BUCKETS = (1, 10, 100, 1000, 10000, 100000)
+
+
+class Counter:
+    def __init__(self, name, help) -> None:
+        self.name = name
+        self.help = help
+        self.series = {}
+
+    def inc(self, labels, value=1.0) -> None:
+        self.series[labels] = self.series.get(labels, 0.0) + value
+
+    def samples(self) -> list:
+        return [Sample(self.name, labels, value, 'counter', self.help) for labels, value in self.series.items()]
+
+
+class Gauge:
+    def __init__(self, name, help) -> None:
+        self.name = name
+        self.help = help
+        self.series = {}
+
+    def set(self, labels, value) -> None:
+        self.series[labels] = float(value)
+
+    def samples(self) -> list:
+        return [Sample(self.name, labels, value, 'gauge', self.help) for labels, value in self.series.items()]
+
+
+# Keeps per bucket counts and renders them cumulative, so an observation is a single bisect
+class Histogram:
+    def __init__(self, name, help, buckets) -> None:
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        # labels -> [count of every bucket and of +Inf, sum, count]
+        self.series = {}
+
+    def observe(self, labels, value) -> None:
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def samples(self) -> list:
+        samples = []
+        for labels, series in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), series):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(float(bound))
+                samples.append(Sample(f'{self.name}_bucket', labels + (('le', le),), float(cumulative), 'histogram',
+                                      self.help, self.name))
+            samples.append(Sample(f'{self.name}_sum', labels, series[-2], 'histogram', self.help, self.name))
+            samples.append(Sample(f'{self.name}_count', labels, float(series[-1]), 'histogram', self.help, self.name))
+        return samples
+
+
+class SelfMetrics:
+    def __init__(self) -> None:
+        self.queryDuration = Histogram('pg_collector_query_duration_seconds', 'Execution time of a query',
+                                       DURATION_BUCKETS)
+        self.queryRows = Histogram('pg_collector_query_rows', 'Rows returned by a query', COUNT_BUCKETS)
+        self.querySeries = Histogram('pg_collector_query_series', 'Series emitted from the result of a query',
+                                     COUNT_BUCKETS)
+        self.queryTime = Counter('pg_collector_query_seconds_total', 'Time spent running a query on an instance')
+        self.queryErrors = Counter('pg_collector_query_errors_total', 'Queries that failed')
+        self.queryTimeouts = Counter('pg_collector_query_timeouts_total',
+                                     'Queries cancelled by the server by reason: statement or lock timeout')
+        self.queryIntervalFactor = Gauge('pg_collector_query_interval_factor',
+                                         'Factor the interval of a query is stretched by because it ran close to its '
+                                         'time budget, highest over the databases of the instance')
+        self.seriesCapped = Counter('pg_collector_series_capped_total', 'Series dropped by the max_series cap of a query')
+        self.scrapeDuration = Histogram('pg_collector_scrape_duration_seconds', 'Duration of the instance scrapes',
+                                        DURATION_BUCKETS)
+        self.lastScrapeDuration = Gauge('pg_collector_scrape_last_duration_seconds',
+                                        'Duration of the last scrape of an instance')
+        self.scrapes = Counter('pg_collector_scrapes_total', 'Instance scrapes by result')
+        self.connectionErrors = Counter('pg_collector_connection_errors_total', 'Failed connections to an instance')
+        self.replicaFailovers = Counter('pg_collector_replica_failovers_total',
+                                        'Queries that failed on a replica and moved to the next node')
+
+    # The target is left out of the histograms, they would add 25 series per instance and query. The cost of a
+    # query on every instance is kept as a single counter
+    def observeQuery(self, target, query, duration, rows, series) -> None:
+        self.queryTime.inc((('target', target), ('query', query)), duration)
+        labels = (('query', query),)
+        self.queryDuration.observe(labels, duration)
+        self.queryRows.observe(labels, rows)
+        self.querySeries.observe(labels, series)
+
+    def observeScrape(self, target, result, duration=None) -> None:
+        self.scrapes.inc((('target', target), ('result', result)))
+        if duration is not None:
+            self.scrapeDuration.observe((), duration)
+            self.lastScrapeDuration.set((('target', target),), duration)
+
+    def getMetrics(self) -> list:
+        return [self.queryDuration, self.queryRows, self.querySeries, self.queryTime, self.queryErrors,
+                self.queryTimeouts, self.queryIntervalFactor, self.seriesCapped, self.scrapeDuration,
+                self.lastScrapeDuration, self.scrapes,
+                self.connectionErrors, self.replicaFailovers]
+
+    # Drops the series of an instance that is no longer scraped
+    def removeTarget(self, target) -> None:
+        for metric in self.getMetrics():
+            for labels in [labels for labels in metric.series if labels and labels[0] == ('target', target)]:
+                metric.series.pop(labels)
+
+    def samples(self) -> list:
+        return [sample for metric in self.getMetrics() for sample in metric.samples()]
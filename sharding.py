@@ -0,0 +1,38 @@
+"""
+This module splits the instance list between collector replicas. Every instance goes to the member with the
+highest hash of member and instance key (rendezvous hashing), so adding or removing one of N members moves
+only about 1/N of the instances, and every replica computes the same split from the same list
+"""
+import hashlib
+
+
+def getWeight(member, key) -> int:
+    return int.from_bytes(hashlib.sha1(f'{member}/{key}'.encode()).digest()[:8], 'big')
+
+
+# Returns the member that scrapes an instance
+def getOwner(key, members) -> str:
+    return max(members, key=lambda member: getWeight(member, key))
+
+
+# Returns the name of this replica and the names of all replicas from the pg settings, or None and an empty list
+# when sharding is off. Either pg_shard_index and pg_shard_count or pg_shard_name and pg_shard_members are set
+def getMembership(settings) -> tuple:
+    members = [str(member) for member in settings.get('pg_shard_members') or []]
+    if members:
+        name = str(settings.get('pg_shard_name', ''))
+        if name not in members:
+            raise ValueError(f'pg_shard_name "{name}" is not one of pg_shard_members {members}')
+        return name, members
+    count = int(settings.get('pg_shard_count', 0))
+    if count <= 1:
+        return None, []
+    index = int(settings.get('pg_shard_index', 0))
+    if not 0 <= index < count:
+        raise ValueError(f'pg_shard_index must be between 0 and {count - 1}, got {index}')
+    return str(index), [str(i) for i in range(count)]
+
+
+# Returns the instances this member scrapes, getKey returns the stable key of an instance
+def selectInstances(instances, member, members, getKey) -> list:
+    return [instance for instance in instances if getOwner(getKey(instance), members) == member]
@@ -0,0 +1,235 @@
+"""
+This module runs the postgres exporter processes when the builder manages them itself instead of the collector,
+so the instance list can change without restarting the collector or the exporters of unchanged instances.
+It also samples the memory and cpu of every exporter from /proc, restarts an exporter that exits or breaks its
+limits with exponential backoff, and serves these stats as metrics
+"""
+import http.server
+import json
+import logging
+import os
+import shlex
+import subprocess
+import threading
+import time
+
+from exposition import Sample, renderExposition
+
+RESTART_INITIAL_BACKOFF = 1
+RESTART_MAX_BACKOFF = 300
+# cpu samples in a row above the limit before an exporter is restarted, scrapes cause short spikes
+CPU_LIMIT_SAMPLES = 3
+
+
+# Returns the cpu seconds and resident memory in bytes of a process, or None when it is gone
+def readProcessStats(pid):
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except (OSError, IndexError):
+        return None
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    return cpu, int(fields[21]) * os.sysconf('SC_PAGE_SIZE')
+
+
+class ExporterSupervisor:
+    def __init__(self, targetsPath, maxRssBytes=0, maxCpuPercent=0, clock=time.monotonic,
+                 initialBackoff=RESTART_INITIAL_BACKOFF, maxBackoff=RESTART_MAX_BACKOFF) -> None:
+        self.targetsPath = targetsPath
+        self.maxRssBytes = maxRssBytes
+        self.maxCpuPercent = maxCpuPercent
+        self.clock = clock
+        self.initialBackoff = initialBackoff
+        self.maxBackoff = maxBackoff
+        self.receivers = {}
+        self.processes = {}
+        # receiver id -> {'started', 'cpu', 'rss', 'cpuPercent', 'cpuOverLimit', 'sampled'}
+        self.stats = {}
+        # receiver id -> restarts in a row that did not last, and time of the next restart
+        self.failures = {}
+        self.restartAt = {}
+        # (receiver id, reason) -> restarts
+        self.restarts = {}
+        self.lock = threading.Lock()
+        self.server = None
+        self.logger = logging.getLogger(__name__)
+
+    # Starts the exporter of a receiver, unless a process of it still runs
+    def startExporter(self, receiverId) -> None:
+        current = self.processes.get(receiverId)
+        if current is not None and current.poll() is None:
+            self.logger.debug(f'Exporter {receiverId} already runs')
+            return
+        receiver = self.receivers[receiverId]
+        env = dict(os.environ)
+        env.update({var['name']: str(var['value']) for var in receiver['env']})
+        process = subprocess.Popen(shlex.split(receiver['exec']), env=env)
+        with self.lock:
+            self.processes[receiverId] = process
+            self.stats[receiverId] = {'started': self.clock(), 'cpu': 0.0, 'rss': 0, 'cpuPercent': 0.0,
+                                      'cpuOverLimit': 0, 'sampled': None}
+        self.logger.debug(f'Started exporter {receiverId} on port {receiver["port"]}')
+
+    def stopExporter(self, receiverId) -> None:
+        with self.lock:
+            process = self.processes.pop(receiverId, None)
+        if process is None:
+            return
+        process.terminate()
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+        self.logger.debug(f'Stopped exporter {receiverId}')
+
+    # Applies a new set of receivers by id, only added, removed and changed receivers are touched.
+    # Returns the ids of the added, removed and changed receivers
+    def apply(self, receivers) -> tuple:
+        added = [receiverId for receiverId in receivers if receiverId not in self.receivers]
+        removed = [receiverId for receiverId in self.receivers if receiverId not in receivers]
+        changed = [receiverId for receiverId in receivers
+                   if receiverId in self.receivers and receivers[receiverId] != self.receivers[receiverId]]
+        for receiverId in removed + changed:
+            self.stopExporter(receiverId)
+        with self.lock:
+            for receiverId in removed:
+                self.stats.pop(receiverId, None)
+                for key in [key for key in self.restarts if key[0] == receiverId]:
+                    self.restarts.pop(key)
+            # a changed receiver starts right away with new settings, its pending restart and backoff are dropped
+            for receiverId in removed + changed:
+                self.failures.pop(receiverId, None)
+                self.restartAt.pop(receiverId, None)
+            self.receivers = dict(receivers)
+        for receiverId in changed + added:
+            self.startExporter(receiverId)
+        self.writeTargets()
+        return added, removed, changed
+
+    # Stops an exporter and schedules its restart. The first restart is immediate, every further restart of an
+    # exporter that did not run for the max backoff waits twice as long as the previous one
+    def scheduleRestart(self, receiverId, reason) -> None:
+        self.stopExporter(receiverId)
+        now = self.clock()
+        with self.lock:
+            started = self.stats.get(receiverId, {}).get('started', now)
+            if now - started >= self.maxBackoff:
+                self.failures[receiverId] = 0
+            failures = self.failures.get(receiverId, 0)
+            self.failures[receiverId] = failures + 1
+            delay = min(self.initialBackoff * 2 ** (failures - 1), self.maxBackoff) if failures else 0
+            self.restartAt[receiverId] = now + delay
+            self.restarts[(receiverId, reason)] = self.restarts.get((receiverId, reason), 0) + 1
+        self.logger.warning(f'Restarting exporter {receiverId} ({reason}) in {delay}s')
+
+    # Schedules the restart of exporters that exited. Returns their ids
+    def restartExited(self) -> list:
+        exited = [receiverId for receiverId, process in list(self.processes.items()) if process.poll() is not None]
+        for receiverId in exited:
+            self.logger.warning(f'Exporter {receiverId} exited with code {self.processes[receiverId].returncode}')
+            self.scheduleRestart(receiverId, 'exit')
+        self.startDue()
+        return exited
+
+    # Starts the exporters whose restart time has come
+    def startDue(self) -> list:
+        now = self.clock()
+        due = [receiverId for receiverId, restartAt in self.restartAt.items() if restartAt <= now]
+        for receiverId in due:
+            self.restartAt.pop(receiverId)
+            if receiverId in self.receivers:
+                self.startExporter(receiverId)
+        return due
+
+    # Samples memory and cpu of every exporter, and schedules the restart of exporters over their limits.
+    # Returns the ids of the exporters restarted for a limit
+    def sample(self) -> list:
+        breached = []
+        now = self.clock()
+        for receiverId, process in list(self.processes.items()):
+            result = readProcessStats(process.pid)
+            if result is None:
+                continue
+            cpu, rss = result
+            with self.lock:
+                stats = self.stats[receiverId]
+                if stats['sampled'] is not None and now > stats['sampled']:
+                    stats['cpuPercent'] = 100 * (cpu - stats['cpu']) / (now - stats['sampled'])
+                stats.update(cpu=cpu, rss=rss, sampled=now)
+                overCpu = self.maxCpuPercent > 0 and stats['cpuPercent'] > self.maxCpuPercent
+                stats['cpuOverLimit'] = stats['cpuOverLimit'] + 1 if overCpu else 0
+            if self.maxRssBytes > 0 and rss > self.maxRssBytes:
+                breached.append((receiverId, 'memory'))
+            elif stats['cpuOverLimit'] >= CPU_LIMIT_SAMPLES:
+                breached.append((receiverId, 'cpu'))
+        for receiverId, reason in breached:
+            self.scheduleRestart(receiverId, reason)
+        return [receiverId for receiverId, _ in breached]
+
+    # One supervision round: sample, restart exporters that exited or broke a limit when their backoff is over
+    def supervise(self) -> None:
+        self.sample()
+        self.restartExited()
+
+    def getSamples(self) -> list:
+        samples = []
+        with self.lock:
+            for receiverId in sorted(self.receivers):
+                labels = (('exporter', receiverId),)
+                stats = self.stats.get(receiverId)
+                running = receiverId in self.processes
+                samples.append(Sample('pg_exporter_process_up', labels, 1.0 if running else 0.0, 'gauge',
+                                      'Whether the exporter process runs'))
+                if stats is not None and running:
+                    samples.append(Sample('pg_exporter_process_resident_memory_bytes', labels, float(stats['rss']),
+                                          'gauge', 'Resident memory of the exporter process'))
+                    samples.append(Sample('pg_exporter_process_cpu_seconds_total', labels, stats['cpu'], 'counter',
+                                          'Cpu time of the current exporter process'))
+                    samples.append(Sample('pg_exporter_process_cpu_percent', labels, stats['cpuPercent'], 'gauge',
+                                          'Cpu use of the exporter process between the last two samples'))
+            for (receiverId, reason), count in sorted(self.restarts.items()):
+                samples.append(Sample('pg_exporter_process_restarts_total',
+                                      (('exporter', receiverId), ('reason', reason)), float(count), 'counter',
+                                      'Exporter restarts by reason: exit, memory or cpu'))
+        return samples
+
+    # Serves the process stats in prometheus format from a background thread
+    def serveMetrics(self, port, host='127.0.0.1') -> int:
+        supervisor = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                found = self.path.split('?')[0] == '/metrics'
+                body = renderExposition(supervisor.getSamples()).encode() if found else b'not found\n'
+                self.send_response(200 if found else 404)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.server.server_address[1]
+
+    # Writes the exporter addresses for the collector's file based service discovery, the file is replaced
+    # atomically so the collector never reads a partial list
+    def writeTargets(self) -> None:
+        targets = [{'targets': [f'localhost:{receiver["port"]}']}
+                   for _, receiver in sorted(self.receivers.items())]
+        tmpPath = f'{self.targetsPath}.tmp'
+        with open(tmpPath, 'w') as f:
+            json.dump(targets, f, indent=2)
+        os.replace(tmpPath, self.targetsPath)
+
+    def stopAll(self) -> None:
+        for receiverId in list(self.processes):
+            self.stopExporter(receiverId)
+        self.restartAt = {}
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
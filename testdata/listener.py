@@ -0,0 +1,144 @@
+"""
+A stand-in for the logz.io listener, it decodes the remote write requests it receives so tests can check them
+"""
+import http.server
+import struct
+import threading
+
+
+def decodeVarint(data, pos) -> tuple:
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+# Decodes the snappy block format, literals and all copy kinds
+def decompressBlock(data) -> bytes:
+    length, pos = decodeVarint(data, 0)
+    out = bytearray()
+    while pos < len(data):
+        tag = data[pos]
+        pos += 1
+        kind = tag & 3
+        if kind == 0:
+            size = tag >> 2
+            if size >= 60:
+                extra = size - 59
+                size = int.from_bytes(data[pos:pos + extra], 'little')
+                pos += extra
+            size += 1
+            out += data[pos:pos + size]
+            pos += size
+            continue
+        if kind == 1:
+            size = ((tag >> 2) & 7) + 4
+            offset = ((tag >> 5) << 8) | data[pos]
+            pos += 1
+        elif kind == 2:
+            size = (tag >> 2) + 1
+            offset = int.from_bytes(data[pos:pos + 2], 'little')
+            pos += 2
+        else:
+            size = (tag >> 2) + 1
+            offset = int.from_bytes(data[pos:pos + 4], 'little')
+            pos += 4
+        for _ in range(size):
+            out.append(out[-offset])
+    assert len(out) == length
+    return bytes(out)
+
+
+# Returns the (field number, wire type, value) of every field of a protobuf message
+def decodeFields(data) -> list:
+    fields = []
+    pos = 0
+    while pos < len(data):
+        key, pos = decodeVarint(data, pos)
+        number, wireType = key >> 3, key & 7
+        if wireType == 0:
+            value, pos = decodeVarint(data, pos)
+        elif wireType == 1:
+            value = data[pos:pos + 8]
+            pos += 8
+        else:
+            size, pos = decodeVarint(data, pos)
+            value = data[pos:pos + size]
+            pos += size
+        fields.append((number, wireType, value))
+    return fields
+
+
+# Returns the series of a WriteRequest as a list of (labels dict, [(value, timestamp)])
+def decodeWriteRequest(data) -> list:
+    series = []
+    for _, _, timeSeries in decodeFields(data):
+        labels = {}
+        points = []
+        for number, _, value in decodeFields(timeSeries):
+            fields = {n: v for n, _, v in decodeFields(value)}
+            if number == 1:
+                labels[fields[1].decode()] = fields[2].decode()
+            else:
+                points.append((struct.unpack('<d', fields[1])[0], fields.get(2, 0)))
+        series.append((labels, points))
+    return series
+
+
+class RemoteWriteListener:
+    # with decode off only the requests and their size are counted, which keeps the listener cheap in benchmarks
+    def __init__(self, decode=True) -> None:
+        self.decode = decode
+        self.receivedBytes = 0
+        self.requests = []
+        self.series = []
+        self.connections = 0
+        # status returned to the next requests, 200 when empty
+        self.statuses = []
+        # while set every request fails with 503
+        self.stalled = False
+        self.lock = threading.Lock()
+        listener = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                with listener.lock:
+                    listener.connections += 1
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                with listener.lock:
+                    status = listener.statuses.pop(0) if listener.statuses else 200
+                    if listener.stalled:
+                        status = 503
+                    if status == 200:
+                        listener.receivedBytes += len(body)
+                        listener.requests.append((dict(self.headers), body if listener.decode else None))
+                        if listener.decode:
+                            listener.series.extend(decodeWriteRequest(decompressBlock(body)))
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
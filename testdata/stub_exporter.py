@@ -0,0 +1,70 @@
+"""
+A stand-in for postgres_exporter that serves canned metrics without a database. It is configured with the same
+environment variables the builder gives postgres_exporter, and serves STUB_SERIES_PER_TARGET series for every
+target in DATA_SOURCE_NAME. It can also misbehave on purpose: STUB_LEAK_MB holds that much memory,
+STUB_BURN_CPU=true keeps a cpu busy and STUB_EXIT_AFTER exits after that many seconds
+"""
+import http.server
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+def getTargets() -> list:
+    targets = []
+    for dsn in os.environ.get('DATA_SOURCE_NAME', '').split(','):
+        if dsn:
+            parsed = urlsplit(dsn)
+            targets.append(f'{parsed.hostname}:{parsed.port or 5432}')
+    return targets
+
+
+def getConstantLabels() -> str:
+    labels = [label.split('=', 1) for label in os.environ.get('PG_EXPORTER_CONSTANT_LABELS', '').split(',') if label]
+    return ''.join(f',{name}="{value}"' for name, value in labels)
+
+
+def renderMetrics(targets, seriesPerTarget) -> bytes:
+    constantLabels = getConstantLabels()
+    lines = ['# HELP pg_up Whether the last scrape was able to connect to the server', '# TYPE pg_up gauge']
+    lines.extend(f'pg_up{{server="{target}"{constantLabels}}} 1' for target in targets)
+    lines.extend(['# HELP pg_stub_value Canned value', '# TYPE pg_stub_value gauge'])
+    for target in targets:
+        lines.extend(f'pg_stub_value{{server="{target}",id="{i}"{constantLabels}}} {i}'
+                     for i in range(seriesPerTarget - 1))
+    return ('\n'.join(lines) + '\n').encode()
+
+
+def burnCpu() -> None:
+    while True:
+        pass
+
+
+def main() -> None:
+    body = renderMetrics(getTargets(), int(os.environ.get('STUB_SERIES_PER_TARGET', 200)))
+    # written bytes, so the pages are resident, held until the process exits
+    leak = b'x' * int(os.environ.get('STUB_LEAK_MB', 0)) * 2 ** 20
+    if os.environ.get('STUB_BURN_CPU', '').lower() == 'true':
+        threading.Thread(target=burnCpu, daemon=True).start()
+    if os.environ.get('STUB_EXIT_AFTER'):
+        time.sleep(float(os.environ['STUB_EXIT_AFTER']))
+        os._exit(1)
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200 if self.path.startswith('/metrics') else 404)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    port = int(os.environ.get('PG_EXPORTER_WEB_LISTEN_ADDRESS', ':9187').rsplit(':', 1)[1])
+    http.server.HTTPServer(('', port), Handler).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
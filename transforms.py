@@ -0,0 +1,167 @@
+"""
+This module holds the row transforms the native engine applies to query results before they become samples,
+they are configured per query block in the queries files
+"""
+import hashlib
+import re
+
+OTHER_LABEL = 'other'
+
+
+# Returns the LABEL columns of a query block
+def getLabelColumns(queryDef) -> list:
+    columns = []
+    for metric in queryDef.get('metrics', []):
+        for column, settings in metric.items():
+            if settings.get('usage', '').upper() == 'LABEL':
+                columns.append(column)
+    return columns
+
+
+# Returns the COUNTER and GAUGE columns of a query block
+def getMetricColumns(queryDef) -> list:
+    columns = []
+    for metric in queryDef.get('metrics', []):
+        for column, settings in metric.items():
+            if settings.get('usage', '').upper() in ('COUNTER', 'GAUGE'):
+                columns.append(column)
+    return columns
+
+
+# Returns a short stable hash of a label value, whitespace differences do not change it
+def fingerprint(value) -> str:
+    normalized = ' '.join(str(value).split())
+    return hashlib.sha1(normalized.encode()).hexdigest()[:16]
+
+
+# Keeps the previous snapshot of a query, and reduces the current snapshot to the K rows with the largest
+# change since then. The changes of all other rows are summed into a single "other" row
+class DeltaTopK:
+    def __init__(self, settings, labelColumns) -> None:
+        self.limit = int(settings.get('limit', 100))
+        self.orderBy = settings['order_by']
+        self.deltaColumns = settings.get('delta', [self.orderBy])
+        if self.orderBy not in self.deltaColumns:
+            self.deltaColumns = self.deltaColumns + [self.orderBy]
+        self.labelColumns = labelColumns
+        self.previous = None
+        self.metrics = [{f'{column}_delta': {'usage': 'GAUGE',
+                                             'description': f'Change of {column} since the previous scrape'}}
+                        for column in self.deltaColumns]
+
+    # Returns the per interval change of the delta columns of a row, a value that went down means the
+    # statistics were reset, so the whole value is new
+    def getDelta(self, row, previousRow) -> dict:
+        delta = {}
+        for column in self.deltaColumns:
+            value = float(row.get(column) or 0)
+            previousValue = float(previousRow.get(column) or 0) if previousRow is not None else 0.0
+            delta[column] = value - previousValue if value >= previousValue else value
+        return delta
+
+    def apply(self, rows) -> list:
+        current = {tuple(row.get(c) for c in self.labelColumns): row for row in rows}
+        previous = self.previous
+        self.previous = {key: {c: row.get(c) for c in self.deltaColumns} for key, row in current.items()}
+        # the first snapshot has nothing to compare with
+        if previous is None:
+            return []
+        changes = []
+        for key, row in current.items():
+            delta = self.getDelta(row, previous.get(key))
+            if any(delta.values()):
+                changes.append((row, delta))
+        changes.sort(key=lambda change: change[1][self.orderBy], reverse=True)
+        result = []
+        for row, delta in changes[:self.limit]:
+            row = dict(row)
+            for column, value in delta.items():
+                row[f'{column}_delta'] = value
+            result.append(row)
+        other = {column: OTHER_LABEL for column in self.labelColumns}
+        for column in self.deltaColumns:
+            other[f'{column}_delta'] = sum(delta[column] for _, delta in changes[self.limit:])
+        result.append(other)
+        return result
+
+
+# Keeps only rows whose values match all the include patterns and none of the exclude patterns,
+# patterns must match the whole value
+class RowFilter:
+    def __init__(self, include, exclude) -> None:
+        self.include = [(column, re.compile(pattern)) for column, pattern in (include or {}).items()]
+        self.exclude = [(column, re.compile(pattern)) for column, pattern in (exclude or {}).items()]
+
+    def matches(self, row) -> bool:
+        for column, pattern in self.include:
+            if pattern.fullmatch(str(row.get(column, ''))) is None:
+                return False
+        for column, pattern in self.exclude:
+            if pattern.fullmatch(str(row.get(column, ''))) is not None:
+                return False
+        return True
+
+    def apply(self, rows) -> list:
+        return [row for row in rows if self.matches(row)]
+
+
+# Bounds the series a query emits, keeping the rows with the highest value of the top_n_by column when it is set
+class SeriesCap:
+    def __init__(self, maxSeries, topNBy, metricColumns) -> None:
+        self.maxSeries = int(maxSeries)
+        self.topNBy = topNBy
+        self.metricColumns = metricColumns
+
+    # Returns the kept rows and the number of dropped series
+    def apply(self, rows) -> tuple:
+        counts = [sum(1 for column in self.metricColumns if column in row) for row in rows]
+        if sum(counts) <= self.maxSeries:
+            return rows, 0
+        ranked = list(zip(rows, counts))
+        if self.topNBy is not None:
+            ranked.sort(key=lambda item: float(item[0].get(self.topNBy) or 0), reverse=True)
+        kept = []
+        series = 0
+        for row, count in ranked:
+            if series + count > self.maxSeries:
+                break
+            kept.append(row)
+            series += count
+        return kept, sum(counts) - series
+
+
+# Applies the transforms configured on a query block, keeps state between scrapes so there should be one
+# per query per instance
+class QueryTransform:
+    def __init__(self, queryDef) -> None:
+        labelColumns = getLabelColumns(queryDef)
+        self.filter = RowFilter(queryDef.get('include'), queryDef.get('exclude')) \
+            if 'include' in queryDef or 'exclude' in queryDef else None
+        self.topK = DeltaTopK(queryDef['top_k'], labelColumns) if 'top_k' in queryDef else None
+        self.fingerprintColumns = queryDef.get('fingerprint', [])
+        metrics = list(queryDef.get('metrics', []))
+        if self.topK is not None:
+            metrics.extend(self.topK.metrics)
+        self.queryDef = dict(queryDef, metrics=metrics)
+        self.cap = SeriesCap(queryDef['max_series'], queryDef.get('top_n_by'), getMetricColumns(self.queryDef)) \
+            if 'max_series' in queryDef else None
+        # series dropped by the cap on the last apply
+        self.droppedSeries = 0
+
+    def apply(self, rows) -> list:
+        if self.filter is not None:
+            rows = self.filter.apply(rows)
+        if self.topK is not None:
+            rows = self.topK.apply(rows)
+        if self.cap is not None:
+            rows, self.droppedSeries = self.cap.apply(rows)
+        if self.fingerprintColumns:
+            rows = [self.fingerprintRow(row) for row in rows]
+        return rows
+
+    def fingerprintRow(self, row) -> dict:
+        row = dict(row)
+        for column in self.fingerprintColumns:
+            if row.get(column) is not None and row[column] != OTHER_LABEL:
+                row[column] = fingerprint(row[column])
+        return row